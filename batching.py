@@ -0,0 +1,153 @@
+import bisect
+import collections
+import numpy as np
+
+from create_data import load_packed_data, iter_packed_examples
+
+"""
+Padded mini-batches of tokenized (target, src) examples, grouping examples of
+similar source length into buckets so little of each batch is padding.
+"""
+
+# dial_ids: (batch,) array, target/src: (batch, max len in batch) arrays of ids padded
+# with pad id, target_mask/src_mask: 1.0 for tokens and 0.0 for padding
+Batch = collections.namedtuple("Batch", ["dial_ids", "target", "target_mask", "src", "src_mask"])
+
+default_bucket_boundaries = (16, 32, 64, 128, 256)
+
+
+def iter_tok_examples(tok_file):
+    """
+    Read examples of tokenized file written by tokenize_data
+    :param tok_file: file of "idx \t target ids \t src ids" lines
+    :return: generator of (dial_id, target_ids, src_ids) with ids as int32 arrays
+    """
+    with open(tok_file, "rb") as f:
+        for line in f:
+            idx, target, src = line.split("\t")
+            yield (int(idx), np.array(target.split(), dtype=np.int32),
+                   np.array(src.split(), dtype=np.int32))
+
+
+def truncate_example(target_ids, src_ids, max_target_len=None, max_src_len=None):
+    """
+    Truncate target to its first max_target_len ids and src to its last max_src_len
+    ids, as the end of the source holds the most recent turns
+    :param target_ids:
+    :param src_ids:
+    :param max_target_len:
+    :param max_src_len:
+    :return: (target_ids, src_ids)
+    """
+    if max_target_len is not None:
+        target_ids = target_ids[:max_target_len]
+    if max_src_len is not None and len(src_ids) > max_src_len:
+        src_ids = src_ids[len(src_ids) - max_src_len:]
+
+    return target_ids, src_ids
+
+
+def pad_sequences(seqs, pad_id=0, dtype=np.int32):
+    """
+    Pad sequences on the right to the length of the longest one
+    :param seqs: list of id arrays
+    :param pad_id:
+    :param dtype:
+    :return: (padded ids, mask) arrays of shape (len(seqs), max length)
+    """
+    max_len = max(len(s) for s in seqs) if seqs else 0
+    ids = np.full((len(seqs), max_len), pad_id, dtype=dtype)
+    mask = np.zeros((len(seqs), max_len), dtype=np.float32)
+    for i, s in enumerate(seqs):
+        ids[i, :len(s)] = s
+        mask[i, :len(s)] = 1.0
+
+    return ids, mask
+
+
+def make_batch(examples, pad_id=0):
+    """
+    Pad list of (dial_id, target_ids, src_ids) examples into a Batch
+    :param examples:
+    :param pad_id:
+    :return:
+    """
+    target, target_mask = pad_sequences([e[1] for e in examples], pad_id)
+    src, src_mask = pad_sequences([e[2] for e in examples], pad_id)
+    return Batch(np.array([e[0] for e in examples], dtype=np.int64), target, target_mask,
+                 src, src_mask)
+
+
+def iter_batches(examples, batch_size, bucket_boundaries=default_bucket_boundaries,
+                 max_target_len=None, max_src_len=None, shuffle=False, seed=0, pad_id=0,
+                 drop_last=False):
+    """
+    Group examples into buckets by (truncated) source length and yield padded batches
+    of examples of one bucket. Without shuffling, examples are streamed and a batch is
+    yielded as soon as its bucket is full. With shuffling, examples are collected,
+    shuffled within their buckets and batches are yielded in shuffled order, both
+    reproducibly given seed.
+    :param examples: iterable of (dial_id, target_ids, src_ids)
+    :param batch_size:
+    :param bucket_boundaries: sorted source lengths at which buckets are split; a
+    bucket holds lengths up to and including its boundary
+    :param max_target_len: max target length, longer targets lose their end
+    :param max_src_len: max source length, longer sources lose their beginning
+    :param shuffle:
+    :param seed: seed of shuffling
+    :param pad_id: id used for padding
+    :param drop_last: skip batches smaller than batch_size left over in each bucket
+    :return: generator of Batch
+    """
+    buckets = collections.defaultdict(list)
+
+    for dial_id, target_ids, src_ids in examples:
+        target_ids, src_ids = truncate_example(target_ids, src_ids, max_target_len, max_src_len)
+        bucket = buckets[bisect.bisect_left(bucket_boundaries, len(src_ids))]
+        bucket.append((dial_id, target_ids, src_ids))
+
+        if not shuffle and len(bucket) == batch_size:
+            yield make_batch(bucket, pad_id)
+            del bucket[:]
+
+    rng = np.random.RandomState(seed)
+    batches = []
+    for b in sorted(buckets):
+        bucket = buckets[b]
+        if shuffle:
+            order = rng.permutation(len(bucket))
+            bucket = [bucket[i] for i in order]
+
+        for start in xrange(0, len(bucket), batch_size):
+            batch = bucket[start:start + batch_size]
+            if drop_last and len(batch) < batch_size:
+                continue
+            if shuffle:
+                batches.append(batch)
+            else:
+                yield make_batch(batch, pad_id)
+
+    if shuffle:
+        for i in rng.permutation(len(batches)):
+            yield make_batch(batches[i], pad_id)
+
+
+def iter_tok_batches(tok_file, batch_size, **kwargs):
+    """
+    Yield batches of tokenized file, see iter_batches for options
+    :param tok_file:
+    :param batch_size:
+    :return:
+    """
+    return iter_batches(iter_tok_examples(tok_file), batch_size, **kwargs)
+
+
+def iter_packed_batches(prefix, batch_size, **kwargs):
+    """
+    Yield batches of packed data written by write_packed_data, see iter_batches for
+    options. Examples stay views into the memory-mapped tokens until padded.
+    :param prefix:
+    :param batch_size:
+    :return:
+    """
+    return iter_batches(iter_packed_examples(load_packed_data(prefix)), batch_size, **kwargs)
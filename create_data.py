@@ -1,9 +1,16 @@
 import argparse
+import collections
+import hashlib
+import itertools
 import json
+import multiprocessing
 import numpy as np
+import os.path
 
-from data_utils import clean_text, extract_text_vocab
-from vocab import gen_vocab_file
+from data_utils import clean_text, clean_so_question, iter_so_questions, iter_mailman_threads, \
+    process_file_parallel, ContextWindow, Tokenizer, write_cleaned_so_corpus, convert_mailman_to_jsonl, re_pattern
+from pipeline import Stage, Deferred
+from vocab import gen_vocab_file, gen_vocab_file_sharded, read_vocab_file
 
 
 def gen_data_split(data_file, prefix, split):
@@ -62,7 +69,82 @@ def gen_data_split(data_file, prefix, split):
     test_file.close()
 
 
-def gen_java_nlp_data(so_data_fn, mailman_data_fn, sent_outfile):
+def get_hash_split(d_idx, split, seed=0):
+    """
+    Deterministically assign dialogue to a split by seeded hash of its id
+    :param d_idx: dialogue id string
+    :param split: fractions of data in each split, e.g. [0.8, 0.1, 0.1]
+    :param seed:
+    :return: index of split
+    """
+    point = int(hashlib.md5("{0}:{1}".format(seed, d_idx)).hexdigest()[:8], 16) / float(16 ** 8)
+
+    total = 0.0
+    for split_idx, frac in enumerate(split):
+        total += frac
+        if point < total:
+            return split_idx
+
+    return len(split) - 1
+
+
+def gen_data_split_streaming(data_file, prefix, split, seed=0):
+    """
+    Single-pass version of gen_data_split that assigns each dialogue to a split
+    by seeded hash of its id, streaming the tokenized and parallel sentence files
+    together. Splits are identical across runs with the same seed.
+    :param data_file: directory of data files
+    :param prefix:
+    :param split: train/dev/test fractions
+    :param seed:
+    :return:
+    """
+    split_names = ["train", "val", "test"]
+    tok_files = [open(data_file + prefix + "_" + n + "_tok.txt", "w") for n in split_names]
+    sent_files = [open(data_file + prefix + "_" + n + "_sent.txt", "w") for n in split_names]
+
+    curr_d_idx = None
+    split_idx = None
+    with open(data_file + prefix + "_tok.txt", "r") as f, \
+            open(data_file + prefix + "_par_sent.txt", "r") as f_sent:
+        for tok_point, sent_point in itertools.izip(f, f_sent):
+            d_idx = tok_point[:tok_point.index("\t")]
+
+            # Examples of a dialogue are contiguous so hash once per dialogue
+            if d_idx != curr_d_idx:
+                split_idx = get_hash_split(d_idx, split, seed)
+                curr_d_idx = d_idx
+
+            tok_files[split_idx].write(tok_point)
+            sent_files[split_idx].write(sent_point)
+
+    for f in tok_files + sent_files:
+        f.close()
+
+
+def _gen_data_split_streaming_star(args):
+    return gen_data_split_streaming(*args)
+
+
+def gen_data_splits(data_file, prefixes, split, seed=0, num_workers=None):
+    """
+    Split several corpora concurrently with gen_data_split_streaming
+    :param data_file: directory of data files
+    :param prefixes: list of corpus prefixes
+    :param split: train/dev/test fractions
+    :param seed:
+    :param num_workers: number of processes (defaults to one per corpus)
+    :return:
+    """
+    pool = multiprocessing.Pool(num_workers or len(prefixes))
+    pool.map(_gen_data_split_streaming_star,
+             [(data_file, prefix, split, seed) for prefix in prefixes])
+    pool.close()
+    pool.join()
+
+
+def gen_java_nlp_data(so_data_fn, mailman_data_fn, sent_outfile, max_turns=None,
+                      max_src_tokens=None, keep_first=True):
     """
     Output data to desired format (i.e. ex. id \t src utterance \t tgt utterance).
     SO Data will output dialogues for the following sequences: Q -> [A_1, ..., A_k],
@@ -71,31 +153,24 @@ def gen_java_nlp_data(so_data_fn, mailman_data_fn, sent_outfile):
 
     :param so_data_fn Filename containing Stack overflow data (None if not using this data)
     :param mailman_data_fn Filename containing mailman data (None if not using)
+    :param max_turns: max number of previous replies in src (default all)
+    :param max_src_tokens: max number of whitespace-separated tokens of src (default all)
+    :param keep_first: keep question (or answer) src starts with when limiting src
     :return:
     """
+    def new_window(first):
+        return ContextWindow(first, max_turns, max_src_tokens, keep_first)
+
     output_file = open(sent_outfile, "w")
 
     a_idx = 1
-    if so_data_fn:
-        with open(so_data_fn, "rb") as f:
-            so_data = json.load(f)
-    else:
-        so_data = None
-
-    if mailman_data_fn:
-        with open(mailman_data_fn, "rb") as f:
-            mailman_data = json.load(f)
-    else:
-        mailman_data = None
 
     # Read in so_data and output to file
-    if so_data:
-        for question in so_data:
+    if so_data_fn:
+        for question in iter_so_questions(so_data_fn):
             # TODO: Whether to include text of question title?
-            question = json.loads(question)
-
-            q_body = question["body"].encode("utf-8")
-            q_body = clean_text(q_body)
+            question = clean_so_question(question)
+            q_body = question["body"]
 
             answers = question["answers"]
             comments = question["comments"]
@@ -105,115 +180,312 @@ def gen_java_nlp_data(so_data_fn, mailman_data_fn, sent_outfile):
                 continue
 
             # Create dialogue of form (Q, C_1), (Q+C_1, C_2), etc.
-            curr_c = ""
+            curr_c = new_window(q_body)
             for c in comments:
-                c = c.encode("utf-8")
-                c = clean_text(c)
-                src = q_body + curr_c
+                src = curr_c.text()
                 target = c
                 output_file.write(str(a_idx) + "\t" + target + "\t" + src + "\n")
 
-                curr_c += " " + c
+                curr_c.append(c)
 
                 a_idx += 1
 
             # Create dialogue of form (Q, A_1), (Q+A_1, A_2), etc.
-            curr_a = ""
+            curr_a = new_window(q_body)
             for a in answers:
-                a_text = a["text"].encode("utf-8")
-                a_text = clean_text(a_text)
-                src = q_body + curr_a
+                a_text = a["text"]
+                src = curr_a.text()
                 target = a_text
                 output_file.write(str(a_idx) + "\t" + target + "\t" + src + "\n")
 
-                curr_a += " " + a_text
+                curr_a.append(a_text)
                 a_idx += 1
 
                 # Also of form (A_1, C_11), (A_1+C_11, C_21), etc.
                 a_comments = a["comments"]
-                curr_a_c = ""
+                curr_a_c = new_window(a_text)
                 for a_c in a_comments:
-                    a_c = a_c.encode("utf-8")
-                    a_c = clean_text(a_c)
-                    src = a_text + curr_a_c
+                    src = curr_a_c.text()
                     target = a_c
 
                     output_file.write(str(a_idx) + "\t" + target + "\t" + src + "\n")
 
-                    curr_a_c += " " + a_c
+                    curr_a_c.append(a_c)
                     a_idx += 1
 
     # Read in mailman_data and output to file
-    if mailman_data:
-        for _, thread in mailman_data.iteritems():
+    if mailman_data_fn:
+        for _, thread in iter_mailman_threads(mailman_data_fn):
             # No answer given so no valid dialogue
             if len(thread) == 1:
                 continue
 
             question = thread[0].encode("utf-8)")
             question = clean_text(question)
-            curr_a = ""
+            curr_a = new_window(question)
             for t in thread[1:]:
                 # TODO: Remove "-----" string
                 t = t.encode("utf-8")
                 t = clean_text(t)
-                src = question + curr_a
+                src = curr_a.text()
                 target = t
                 if t == "":
                     continue
 
                 output_file.write(str(a_idx) + "\t" + target + "\t" + src + "\n")
 
-                curr_a += " " + t
+                curr_a.append(t)
                 a_idx += 1
 
     output_file.close()
 
 
-def tokenize_data(data_file, tok_outfile, p_sent_file, vocab_word_to_idx, re_patterns):
+def tokenize_example(example, tokenizer):
+    """
+    Convert one "idx \t target \t src" example into lines of the tokenized and
+    parallel sentence files written by tokenize_data
+    :param example:
+    :param tokenizer: Tokenizer with vocab
+    :return: (tokenized line, parallel sentence line)
+    """
+    idx, target, src = example.split("\t")
+    src_tokens = tokenizer.tokens(src)
+    target_tokens = tokenizer.tokens(target)
+
+    tok_line = (str(idx) + "\t" +
+                "".join(str(t) + " " for t in tokenizer.tokens_to_ids(target_tokens)) + "\t" +
+                "".join(str(s) + " " for s in tokenizer.tokens_to_ids(src_tokens)) + "\n")
+    sent_line = (str(idx) + "\t" +
+                 "".join(str(t) + " " for t in target_tokens) + "\t" +
+                 "".join(str(s) + " " for s in src_tokens) + "\n")
+
+    return tok_line, sent_line
+
+
+def tokenize_data(data_file, tok_outfile, p_sent_file, vocab_word_to_idx, re_patterns,
+                  cache_size=10000):
     """
     Convert data files from word tokens to idx tokens given data word_to_idx file
-    for vocab mapping
+    for vocab mapping. Words missing from vocab are mapped to <unk>
     :param data_file:
     :param tok_outfile: output file for tokens of data
     :param p_sent_file: output file with text of data corresponding to tokenized version
     :param vocab_word_to_idx:
+    :param cache_size: max number of tokenized utterances memoized
     :return:
     """
+    tokenizer = Tokenizer(re_patterns, vocab_word_to_idx, cache_size=cache_size)
+
     with open(data_file, "rb") as f:
         tokenized_file = open(tok_outfile, "wb")
         parallel_sent_file = open(p_sent_file, "wb")
 
         for example in f:
-            idx, target, src = example.split("\t")
-            _, src_tokens = extract_text_vocab(src, re_patterns)
-            _, target_tokens = extract_text_vocab(target, re_patterns)
+            tok_line, sent_line = tokenize_example(example, tokenizer)
+            tokenized_file.write(tok_line)
+            parallel_sent_file.write(sent_line)
 
-            tokenized_file.write(str(idx) + "\t")
-            parallel_sent_file.write(str(idx) + "\t")
+        tokenized_file.close()
+        parallel_sent_file.close()
 
-            # Write target tokens indices
-            for t in target_tokens:
-                tokenized_file.write(str(vocab_word_to_idx[t]) + " ")
-                parallel_sent_file.write(str(t) + " ")
+    if tokenizer.cache is not None:
+        print "Tokenizer cache: ", tokenizer.cache.stats()
 
-            tokenized_file.write("\t")
-            parallel_sent_file.write("\t")
 
-            # Write source tokens indices
-            for s in src_tokens:
-                tokenized_file.write(str(vocab_word_to_idx[s]) + " ")
-                parallel_sent_file.write(str(s) + " ")
+def tokenize_data_parallel(data_file, tok_outfile, p_sent_file, vocab_word_to_idx, re_patterns,
+                           num_workers=None, cache_size=10000):
+    """
+    Same as tokenize_data but tokenize chunks of data file in a pool of processes,
+    merging outputs in original order
+    :param data_file:
+    :param tok_outfile:
+    :param p_sent_file:
+    :param vocab_word_to_idx:
+    :param re_patterns:
+    :param num_workers: number of processes (defaults to number of cpus)
+    :param cache_size: max number of tokenized utterances memoized per process
+    :return:
+    """
+    tokenizer = Tokenizer(re_patterns, vocab_word_to_idx, cache_size=cache_size)
+    process_file_parallel(data_file, [tok_outfile, p_sent_file], tokenize_example,
+                          (tokenizer,), num_workers)
 
-            tokenized_file.write("\n")
-            parallel_sent_file.write("\n")
 
-        tokenized_file.close()
-        parallel_sent_file.close()
+PackedData = collections.namedtuple("PackedData", ["tokens", "offsets", "dial_ids"])
+
+def packed_filenames(prefix):
+    """
+    Return names of (tokens, offsets, dialogue ids, metadata) files of packed data
+    :param prefix:
+    :return:
+    """
+    return (prefix + "_tokens.bin", prefix + "_offsets.npy", prefix + "_dial_ids.npy",
+            prefix + "_meta.json")
+
+
+def write_packed_data(examples, out_prefix, dtype="int32"):
+    """
+    Write examples of token ids as one contiguous token array (target then src ids
+    of each example), an offsets array with (target_start, src_start, end) row per
+    example and an array of dialogue ids
+    :param examples: iterable of (dial_id, target_ids, src_ids)
+    :param out_prefix:
+    :param dtype: dtype of token ids, e.g. int32 or uint16
+    :return: number of examples written
+    """
+    tokens_file, offsets_file, dial_ids_file, meta_file = packed_filenames(out_prefix)
+    dtype = np.dtype(dtype)
+    max_id = np.iinfo(dtype).max
+
+    offsets = []
+    dial_ids = []
+    pos = 0
+    with open(tokens_file, "wb") as f:
+        for dial_id, target_ids, src_ids in examples:
+            ids = np.asarray(list(target_ids) + list(src_ids), dtype=np.int64)
+            if len(ids) and ids.max() > max_id:
+                raise ValueError("Token id {0} does not fit in {1}".format(ids.max(), dtype.name))
+            ids.astype(dtype).tofile(f)
+
+            offsets.append((pos, pos + len(target_ids), pos + len(ids)))
+            dial_ids.append(dial_id)
+            pos += len(ids)
+
+    np.save(offsets_file, np.asarray(offsets, dtype=np.int64).reshape(-1, 3))
+    np.save(dial_ids_file, np.asarray(dial_ids, dtype=np.int64))
+    with open(meta_file, "wb") as f:
+        json.dump({"dtype": dtype.name, "num_examples": len(offsets), "num_tokens": pos}, f)
+
+    return len(offsets)
+
+
+def tokenize_data_packed(data_file, out_prefix, vocab_word_to_idx, re_patterns, dtype="int32",
+                         cache_size=10000):
+    """
+    Same as tokenize_data but output token ids in packed binary form readable
+    with load_packed_data
+    :param data_file:
+    :param out_prefix: prefix of packed output files
+    :param vocab_word_to_idx:
+    :param dtype: dtype of token ids, e.g. int32 or uint16 for vocabs under 65536 words
+    :param cache_size: max number of tokenized utterances memoized
+    :return:
+    """
+    tokenizer = Tokenizer(re_patterns, vocab_word_to_idx, cache_size=cache_size)
+
+    def examples():
+        with open(data_file, "rb") as f:
+            for example in f:
+                idx, target, src = example.split("\t")
+                yield int(idx), tokenizer.ids(target), tokenizer.ids(src)
+
+    return write_packed_data(examples(), out_prefix, dtype)
+
+
+def pack_tokenized_file(tok_file, out_prefix, dtype="int32"):
+    """
+    Convert tokenized file written by tokenize_data to packed binary form
+    :param tok_file:
+    :param out_prefix:
+    :param dtype:
+    :return:
+    """
+    def examples():
+        with open(tok_file, "rb") as f:
+            for line in f:
+                idx, target, src = line.split("\t")
+                yield int(idx), [int(t) for t in target.split()], [int(s) for s in src.split()]
+
+    return write_packed_data(examples(), out_prefix, dtype)
+
+
+def load_packed_data(prefix):
+    """
+    Memory-map packed data written by write_packed_data. Pages of the token file are
+    shared between all processes mapping it.
+    :param prefix:
+    :return: PackedData of read-only arrays
+    """
+    tokens_file, offsets_file, dial_ids_file, meta_file = packed_filenames(prefix)
+    with open(meta_file, "rb") as f:
+        meta = json.load(f)
+
+    if meta["num_tokens"] > 0:
+        tokens = np.memmap(tokens_file, dtype=meta["dtype"], mode="r", shape=(meta["num_tokens"],))
+    else:
+        tokens = np.zeros(0, dtype=meta["dtype"])
+
+    return PackedData(tokens, np.load(offsets_file, mmap_mode="r"),
+                      np.load(dial_ids_file, mmap_mode="r"))
+
+
+def get_packed_example(packed, i):
+    """
+    Return (dial_id, target_ids, src_ids) of ith example, with ids as views into
+    the mapped token array
+    :param packed: PackedData from load_packed_data
+    :param i:
+    :return:
+    """
+    target_start, src_start, end = packed.offsets[i]
+    return (packed.dial_ids[i], packed.tokens[target_start:src_start],
+            packed.tokens[src_start:end])
+
+
+def iter_packed_examples(packed):
+    """
+    Iterate over (dial_id, target_ids, src_ids) of all examples of packed data
+    :param packed:
+    :return:
+    """
+    for i in xrange(len(packed.offsets)):
+        yield get_packed_example(packed, i)
+
+
+def get_java_nlp_stages(data_dir, split=(0.8, 0.1, 0.1)):
+    """
+    Return pipeline stages generating vocab, tokenized data and data split for SO
+    and mailman data. SO texts are cleaned once by the first stage and shared by the
+    vocab and dialogue generation stages.
+    :param data_dir: directory containing snlp_so_questions.json and nlp_user_questions_space.json
+    :param split: train/dev/test fractions
+    :return: list of Stage for run_pipeline
+    """
+    so_raw = data_dir + "snlp_so_questions.json"
+    mailman_raw = data_dir + "nlp_user_questions_space.json"
+    so_clean = data_dir + "snlp_so_questions_clean.jsonl"
+    mailman_jsonl = data_dir + "nlp_user_questions_space.jsonl"
+
+    vocab_files = [data_dir + "so_vocab.txt", data_dir + "mailman_vocab.txt",
+                   data_dir + "so+mailman_vocab.txt"]
+    total_vocab_file = vocab_files[2]
+    sentences = data_dir + "data_sentences.txt"
+    tok_file = data_dir + "data_tok.txt"
+    par_sent_file = data_dir + "data_par_sent.txt"
+    split_files = [data_dir + "data_" + n + suffix for n in ["train", "val", "test"]
+                   for suffix in ["_tok.txt", "_sent.txt"]]
+
+    return [
+        Stage("clean_so", write_cleaned_so_corpus, (so_raw, so_clean), {}, [so_raw], [so_clean]),
+        Stage("convert_mailman", convert_mailman_to_jsonl, (mailman_raw, mailman_jsonl), {},
+              [mailman_raw], [mailman_jsonl]),
+        Stage("vocab", gen_vocab_file_sharded, (data_dir,),
+              {"so_file": os.path.basename(so_clean), "mailman_file": os.path.basename(mailman_jsonl)},
+              [so_clean, mailman_jsonl], vocab_files + [f + ".pkl" for f in vocab_files]),
+        Stage("sentences", gen_java_nlp_data, (so_clean, mailman_jsonl, sentences), {},
+              [so_clean, mailman_jsonl], [sentences]),
+        Stage("tokenize", tokenize_data,
+              (sentences, tok_file, par_sent_file, Deferred(read_vocab_file, (total_vocab_file,)),
+               re_pattern), {},
+              [sentences, total_vocab_file], [tok_file, par_sent_file]),
+        Stage("split", gen_data_split_streaming, (data_dir, "data", list(split)), {},
+              [tok_file, par_sent_file], split_files),
+    ]
 
 
 if __name__ == "__main__":
     pass
+    # run_pipeline(get_java_nlp_stages(data_dir), data_dir + "cache/")
     # parser = argparse.ArgumentParser(description="args for data generation")
     # parser.add_argument("--data_dir", type=str, help="directory containing all data files")
     # args = vars(parser.parse_args())
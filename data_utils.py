@@ -2,34 +2,64 @@ import collections
 import cPickle as pickle
 import matplotlib.pyplot as plt
 import json
+import multiprocessing
+import numpy as np
+import os
 import re
+import shutil
 
 # TODO: Build glove vecs using corpus of Java code?
 # TODO: Generate train/dev/test split of data -- can do that later
 
-def clean_text(text):
+# Tags removed by clean_text, including any attributes (e.g. <code class="java">)
+clean_tags = ["code", "p", "pre", "blockquote", "em", "strong", "li", "ol", "div"]
+# Characters removed by clean_text
+clean_chars = ["\n", "\t"]
+
+def compile_cleaner(tags=clean_tags, chars=clean_chars):
+    """
+    Compile single regex matching opening and closing forms of given tags (with
+    attributes) and given characters, so text is cleaned in one scan
+    :param tags: list of tag names
+    :param chars: list of characters to remove
+    :return:
+    """
+    tag_pattern = r"</?(?:{0})(?:\s[^>]*)?/?>".format("|".join(re.escape(t) for t in tags))
+    char_pattern = "[{0}]".format("".join(re.escape(c) for c in chars))
+
+    return re.compile(tag_pattern + "|" + char_pattern, re.IGNORECASE)
+
+
+default_cleaner = compile_cleaner()
+
+def clean_text(text, cleaner=default_cleaner):
     """
     Clean data from data sources, removing <p> and <code> and various other tags
     :param so_text:
+    :param cleaner: compiled pattern from compile_cleaner
     :return:
     """
     # TODO: Do I want to remove all newlines? Removing for now...
+    return cleaner.sub("", text)
 
-    str_to_replace = ["<code>", "</code", "<p>", "</p>", "<pre>", "</pre>",
-                      "<blockquote>", "</blockquote>", "\n", "<em>", "</em>",
-                      "<strong>", "</strong>", "\t", "<li>", "</li>", "<ol>", "</ol>",
-                      "div", "</div>"]
 
-    new_str = text
-    for s in str_to_replace:
-        new_str = new_str.replace(s, "")
-
-    return new_str
+def clean_texts(texts, cleaner=default_cleaner):
+    """
+    Clean each of given texts as in clean_text
+    :param texts: iterable of texts
+    :param cleaner: compiled pattern from compile_cleaner
+    :return: list of cleaned texts
+    """
+    sub = cleaner.sub
+    return [sub("", t) for t in texts]
 
 
 re_pattern = r"<|>|[\w]+|,|\?|\.|\(|\)|\\|\"|\/|;|\#|\&|\$|\%|\@|\{|\}|\+|\-|\:"
 
-def extract_text_vocab(text, re_pattern):
+# Variant of re_pattern keeping canonicalized entities such as (price*cheap) as one token
+canonical_re_pattern = r"<|>|[(\w*)]+|[\w]+|,|\?|\.|\(|\)|\\|\"|\/|;|\#|\&|\$|\%|\@|\{|\}|\+|\-|\:"
+
+def extract_text_vocab(text, re_pattern=re_pattern):
     """
     Tokenize text and return a set and list of vocab words
     :param text:
@@ -41,23 +71,543 @@ def extract_text_vocab(text, re_pattern):
     return set(lower_tokens), lower_tokens
 
 
+class LRUCache(object):
+    """
+    Mapping holding at most max_size entries, evicting the least recently used,
+    with counters of lookup hits and misses
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        """
+        Return value for key (marking it most recently used) or default if missing
+        :param key:
+        :param default:
+        :return:
+        """
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Store value for key, evicting least recently used entry if full
+        :param key:
+        :param value:
+        :return:
+        """
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def stats(self):
+        """
+        Return dict with hits, misses and size of cache
+        :return:
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.data)}
+
+
+class ContextWindow(object):
+    """
+    Source context of a dialogue built by appending turns, bounded by number of
+    turns and/or number of whitespace-separated tokens by evicting the oldest turns.
+    Turns are stored with the separator they were appended with, so without limits
+    text() equals plain concatenation of the turns. The first text (e.g. the question
+    a thread replies to) is never evicted if keep_first, and the latest turn never is.
+    """
+
+    def __init__(self, first="", max_turns=None, max_tokens=None, keep_first=True):
+        """
+        :param first: text context starts with
+        :param max_turns: max number of turns kept, besides first if keep_first
+        :param max_tokens: max number of tokens of whole context
+        :param keep_first: never evict first text
+        """
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.first = first if keep_first else ""
+        self.first_tokens = len(self.first.split())
+        # Evictable pieces and their token counts
+        self.turns = collections.deque()
+        self.turn_tokens = collections.deque()
+        self.num_tokens = self.first_tokens
+
+        if not keep_first and first:
+            self._push(first)
+
+    def _push(self, piece):
+        num_tokens = len(piece.split())
+        self.turns.append(piece)
+        self.turn_tokens.append(num_tokens)
+        self.num_tokens += num_tokens
+
+        while len(self.turns) > 1 and (
+                (self.max_turns is not None and len(self.turns) > self.max_turns) or
+                (self.max_tokens is not None and self.num_tokens > self.max_tokens)):
+            self.turns.popleft()
+            self.num_tokens -= self.turn_tokens.popleft()
+
+    def append(self, turn, sep=" "):
+        """
+        Append turn to context, joined with sep
+        :param turn:
+        :param sep:
+        :return:
+        """
+        self._push(sep + turn)
+
+    def text(self):
+        return self.first + "".join(self.turns)
+
+
+class Tokenizer(object):
+    """
+    Lowercasing regex tokenizer with a precompiled pattern, optionally mapping
+    tokens to ids of a vocab (unknown words map to <unk>). If cache_size is given,
+    tokens and ids of texts up to cache_max_len characters are memoized in an LRUCache.
+    """
+
+    def __init__(self, pattern=re_pattern, word_to_idx=None, unk_token="<unk>", cache_size=0,
+                 cache_max_len=1000):
+        self.regex = re.compile(pattern)
+        self.word_to_idx = word_to_idx
+        self.unk_idx = word_to_idx[unk_token] if word_to_idx is not None else None
+        self.cache = LRUCache(cache_size) if cache_size > 0 else None
+        self.cache_max_len = cache_max_len
+
+    def _tokenize(self, text):
+        if isinstance(text, str):
+            # Lowercasing a byte string only maps A-Z to a-z, which does not change
+            # what the pattern matches, so lowercase once instead of per token
+            return self.regex.findall(text.lower())
+        return [t.lower() for t in self.regex.findall(text)]
+
+    def _cache_entry(self, text):
+        """
+        Return cached [tokens, ids] entry for text, or None if text is not cacheable
+        """
+        if self.cache is None or len(text) > self.cache_max_len:
+            return None
+
+        entry = self.cache.get(text)
+        if entry is None:
+            entry = [tuple(self._tokenize(text)), None]
+            self.cache.put(text, entry)
+
+        return entry
+
+    def tokens(self, text):
+        """
+        Return list of lowercased tokens of text
+        :param text:
+        :return:
+        """
+        entry = self._cache_entry(text)
+        if entry is None:
+            return self._tokenize(text)
+        return list(entry[0])
+
+    def token_set(self, text):
+        """
+        Return set of lowercased tokens of text
+        :param text:
+        :return:
+        """
+        return set(self.tokens(text))
+
+    def tokens_to_ids(self, tokens):
+        """
+        Map tokens to vocab ids
+        :param tokens:
+        :return:
+        """
+        get = self.word_to_idx.get
+        unk_idx = self.unk_idx
+        return [get(t, unk_idx) for t in tokens]
+
+    def ids(self, text):
+        """
+        Return list of vocab ids of tokens of text
+        :param text:
+        :return:
+        """
+        entry = self._cache_entry(text)
+        if entry is None:
+            return self.tokens_to_ids(self._tokenize(text))
+
+        if entry[1] is None:
+            entry[1] = tuple(self.tokens_to_ids(entry[0]))
+        return list(entry[1])
+
+    def tokenize_many(self, texts, dtype=np.int32):
+        """
+        Yield array of vocab ids for each of given texts
+        :param texts: iterable of texts
+        :param dtype:
+        :return:
+        """
+        for text in texts:
+            yield np.array(self.ids(text), dtype=dtype)
+
+
+def build_matcher(pattern_values):
+    """
+    Build Aho-Corasick automaton for finding all occurrences of many patterns
+    in a single pass over a text
+    :param pattern_values: iterable of (pattern, value) pairs; value is reported on match
+    :return: (goto, fail, output) tables of the automaton
+    """
+    goto = [{}]
+    fail = [0]
+    output = [[]]
+
+    for pattern, value in pattern_values:
+        state = 0
+        for ch in pattern:
+            next_state = goto[state].get(ch)
+            if next_state is None:
+                next_state = len(goto)
+                goto[state][ch] = next_state
+                goto.append({})
+                fail.append(0)
+                output.append([])
+            state = next_state
+        output[state].append(value)
+
+    # Compute failure links breadth-first so shallower states are done first
+    queue = collections.deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for ch, next_state in goto[state].items():
+            queue.append(next_state)
+            f = fail[state]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            fail[next_state] = goto[f].get(ch, 0)
+            output[next_state].extend(output[fail[next_state]])
+
+    return goto, fail, output
+
+
+def find_matches(matcher, text):
+    """
+    Return set of values for all patterns of matcher occurring in text
+    :param matcher: automaton from build_matcher
+    :param text:
+    :return:
+    """
+    goto, fail, output = matcher
+    found = set(output[0])
+    state = 0
+    for ch in text:
+        while state and ch not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(ch, 0)
+        if output[state]:
+            found.update(output[state])
+
+    return found
+
+
+_json_decoder = json.JSONDecoder()
+_json_whitespace = re.compile(r"[ \t\n\r]*")
+
+def iter_json_container(data_file, is_object=False, chunk_size=1 << 16):
+    """
+    Incrementally decode a file holding a top-level JSON array (or object), yielding
+    one element (or (key, value) pair) at a time so only the current element is
+    held in memory
+    :param data_file:
+    :param is_object: whether top-level value is an object rather than an array
+    :param chunk_size: number of bytes read at a time
+    :return:
+    """
+    open_char, close_char = ("{", "}") if is_object else ("[", "]")
+    buf = ""
+    pos = 0
+    eof = False
+    state = "start"
+    key = None
+
+    with open(data_file, "rb") as f:
+        while True:
+            pos = _json_whitespace.match(buf, pos).end()
+            if pos == len(buf):
+                if eof:
+                    raise ValueError("Unexpected end of JSON data in {0}".format(data_file))
+                # Read at least as much as currently buffered so long values are
+                # not re-decoded too many times
+                chunk = f.read(max(chunk_size, len(buf) - pos))
+                buf = buf[pos:] + chunk
+                pos = 0
+                eof = chunk == ""
+                continue
+
+            ch = buf[pos]
+            if state == "start":
+                if ch != open_char:
+                    raise ValueError("Expected '{0}' at start of {1}".format(open_char, data_file))
+                pos += 1
+                state = "first"
+                continue
+
+            if ch == close_char and state in ("first", "after_value"):
+                return
+
+            if state == "after_key":
+                if ch != ":":
+                    raise ValueError("Expected ':' after object key in {0}".format(data_file))
+                pos += 1
+                state = "value"
+                continue
+
+            if state == "after_value":
+                if ch != ",":
+                    raise ValueError("Expected ',' between values in {0}".format(data_file))
+                pos += 1
+                state = "key" if is_object else "value"
+                continue
+
+            try:
+                value, end = _json_decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = len(buf)
+                value = None
+
+            # Value may be truncated at end of buffer, and a truncated number still
+            # decodes (e.g. "2." of "2.5"), so only accept value once the delimiter
+            # following it is buffered. Otherwise read more and decode again.
+            is_key = is_object and state in ("first", "key")
+            delim_pos = _json_whitespace.match(buf, end).end()
+            if not eof and (delim_pos == len(buf) or
+                            buf[delim_pos] not in (":" if is_key else "," + close_char)):
+                chunk = f.read(max(chunk_size, len(buf) - pos))
+                buf = buf[pos:] + chunk
+                pos = 0
+                eof = chunk == ""
+                continue
+
+            pos = end
+            if is_key:
+                key = value
+                state = "after_key"
+            else:
+                yield (key, value) if is_object else value
+                state = "after_value"
+
+
+def iter_so_questions(data_file):
+    """
+    Yield SO questions as dicts one at a time, from either the original json list
+    of json-encoded questions or the json-lines layout of convert_so_to_jsonl
+    :param data_file:
+    :return:
+    """
+    if data_file.endswith(".jsonl"):
+        with open(data_file, "rb") as f:
+            for line in f:
+                yield json.loads(line)
+    else:
+        for question in iter_json_container(data_file):
+            yield json.loads(question)
+
+
+def iter_mailman_threads(data_file):
+    """
+    Yield (title, thread) pairs of mailman data one at a time, from either the
+    original json dict or the json-lines layout of convert_mailman_to_jsonl
+    :param data_file:
+    :return:
+    """
+    if data_file.endswith(".jsonl"):
+        with open(data_file, "rb") as f:
+            for line in f:
+                title, thread = json.loads(line)
+                yield title, thread
+    else:
+        for title, thread in iter_json_container(data_file, is_object=True):
+            yield title, thread
+
+
+def convert_so_to_jsonl(data_file, out_file):
+    """
+    Convert SO data to json-lines with one decoded question per line
+    :param data_file:
+    :param out_file: should end with .jsonl
+    :return:
+    """
+    with open(out_file, "wb") as f:
+        for question in iter_so_questions(data_file):
+            f.write(json.dumps(question) + "\n")
+
+
+def convert_mailman_to_jsonl(data_file, out_file):
+    """
+    Convert mailman data to json-lines with one [title, thread] pair per line
+    :param data_file:
+    :param out_file: should end with .jsonl
+    :return:
+    """
+    with open(out_file, "wb") as f:
+        for title, thread in iter_mailman_threads(data_file):
+            f.write(json.dumps([title, thread]) + "\n")
+
+
+def get_line_chunks(data_file, num_chunks):
+    """
+    Split file into at most num_chunks byte ranges whose boundaries fall on line starts
+    :param data_file:
+    :param num_chunks:
+    :return: list of (start, end) byte offsets
+    """
+    size = os.path.getsize(data_file)
+    bounds = [0]
+
+    with open(data_file, "rb") as f:
+        for i in xrange(1, num_chunks):
+            # Move forward to start of the line containing or following this point
+            f.seek(max(size * i // num_chunks - 1, 0))
+            f.readline()
+            pos = f.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+
+_chunk_worker_state = {}
+
+def _init_chunk_worker(line_fn, fn_args):
+    _chunk_worker_state["line_fn"] = line_fn
+    _chunk_worker_state["fn_args"] = fn_args
+
+
+def _process_chunk(task):
+    data_file, start, end, part_files = task
+    line_fn = _chunk_worker_state["line_fn"]
+    fn_args = _chunk_worker_state["fn_args"]
+
+    part_outs = [open(p, "wb") for p in part_files]
+    with open(data_file, "rb") as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+
+            for out, text in zip(part_outs, line_fn(line, *fn_args)):
+                out.write(text)
+
+    for out in part_outs:
+        out.close()
+
+    return part_files
+
+
+def process_file_parallel(data_file, out_files, line_fn, fn_args=(), num_workers=None,
+                          chunks_per_worker=4):
+    """
+    Apply line_fn(line, *fn_args) to every line of data_file in a pool of processes,
+    writing the ith string it returns to out_files[i] in original line order. Chunks
+    are written to temporary part files which are then concatenated.
+    :param data_file:
+    :param out_files: list of output files
+    :param line_fn: module-level function returning one string per output file
+    :param fn_args: extra arguments of line_fn, shared read-only by workers
+    :param num_workers: number of processes (defaults to number of cpus)
+    :param chunks_per_worker: number of chunks per process, for load balancing
+    :return:
+    """
+    num_workers = num_workers or multiprocessing.cpu_count()
+    chunks = get_line_chunks(data_file, num_workers * chunks_per_worker)
+    tasks = [(data_file, start, end, ["{0}.part{1}".format(o, i) for o in out_files])
+             for i, (start, end) in enumerate(chunks)]
+
+    pool = multiprocessing.Pool(num_workers, _init_chunk_worker, (line_fn, fn_args))
+    outs = [open(o, "wb") for o in out_files]
+    try:
+        # imap yields chunks in order, so parts can be merged as soon as they are done
+        for part_files in pool.imap(_process_chunk, tasks):
+            for out, part in zip(outs, part_files):
+                with open(part, "rb") as f:
+                    shutil.copyfileobj(f, out)
+                os.remove(part)
+    finally:
+        for out in outs:
+            out.close()
+        pool.close()
+        pool.join()
+
+
+def clean_so_question(question):
+    """
+    Return SO question with utf-8 encoded, cleaned body, comments, answers and answer
+    comments. Questions already cleaned by write_cleaned_so_corpus are only encoded.
+    :param question: dict of SO question
+    :return:
+    """
+    if question.get("cleaned"):
+        clean = lambda t: t.encode("utf-8")
+    else:
+        clean = lambda t: clean_text(t.encode("utf-8"))
+
+    return {
+        "body": clean(question["body"]),
+        "comments": [clean(c) for c in question["comments"]],
+        "answers": [{"text": clean(a["text"]), "comments": [clean(a_c) for a_c in a["comments"]]}
+                    for a in question["answers"]],
+        "cleaned": True,
+    }
+
+
+def write_cleaned_so_corpus(data_file, out_file):
+    """
+    Write json-lines file of cleaned SO questions so that stages reading it
+    (vocab, dialogue generation) clean each text only once
+    :param data_file:
+    :param out_file: should end with .jsonl
+    :return:
+    """
+    with open(out_file, "wb") as f:
+        for question in iter_so_questions(data_file):
+            f.write(json.dumps(clean_so_question(question)) + "\n")
+
+
 def so_data_statistics(data_file):
     """
     Report statistics such as number of comments/answers/questions for given data
     :param data_file: json of data file
     :return:
     """
-    with open(data_file, "r") as f:
-        data = json.load(f)
-
     answer_to_num_questions = collections.Counter()
     comment_to_num_questions = collections.Counter()
     num_comments = 0
     num_answers = 0
-    num_questions = len(data)
+    num_questions = 0
 
-    for q in data:
-        q = json.loads(q)
+    for q in iter_so_questions(data_file):
+        num_questions += 1
         q_comments = 0
         q_comments += len(q["comments"])
         q_answers = len(q["answers"])
@@ -81,13 +631,11 @@ def so_data_statistics(data_file):
 
 
 def lists_data_statistics(data_file):
-    with open(data_file, "rb") as f:
-        data = json.load(f)
-
     answer_to_num_questions = collections.Counter()
-    num_questions = len(data)
+    num_questions = 0
 
-    for title, thread in data.iteritems():
+    for title, thread in iter_mailman_threads(data_file):
+        num_questions += 1
         num_answers = len(thread)-1
         answer_to_num_questions[num_answers] += 1
 
@@ -95,72 +643,208 @@ def lists_data_statistics(data_file):
     print "Answers map: ", answer_to_num_questions
 
 
-def compute_data_len(data_file):
+class LengthHistogram(object):
     """
-    Compute average src and target sequences for data file
-    :param data_file:
-    :return:
+    Exact histogram of sequence lengths, from which max, mean, quantiles and CDF
+    values are computed. Memory is bounded by number of distinct lengths rather
+    than number of sequences.
     """
-    max_src_len = -1
-    max_target_len = -1
 
-    sum_src_lens = 0.0
-    sum_target_lens = 0.0
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.total = 0
+        self.sum = 0
+        self.max = -1
+
+    def add(self, length, count=1):
+        self.counts[length] += count
+        self.total += count
+        self.sum += length * count
+        if length > self.max:
+            self.max = length
+
+    def add_lengths(self, lengths):
+        """
+        Add array of lengths at once
+        :param lengths: numpy array of non-negative ints
+        :return:
+        """
+        if len(lengths) == 0:
+            return
+        bins = np.bincount(lengths)
+        for length in np.flatnonzero(bins):
+            self.add(int(length), int(bins[length]))
+
+    def merge(self, other):
+        for length, count in other.counts.iteritems():
+            self.add(length, count)
+
+    def mean(self):
+        return float(self.sum) / self.total if self.total else 0.0
+
+    def cdf(self, threshold):
+        """
+        Return fraction of lengths strictly below threshold
+        :param threshold:
+        :return:
+        """
+        below = sum(count for length, count in self.counts.iteritems() if length < threshold)
+        return float(below) / self.total if self.total else 0.0
+
+    def quantiles(self, qs):
+        """
+        Return smallest lengths L such that at least fraction q of lengths are <= L
+        :param qs: list of fractions in [0, 1]
+        :return:
+        """
+        results = []
+        lengths = sorted(self.counts)
+        for q in qs:
+            needed = q * self.total
+            cumulative = 0
+            result = lengths[-1] if lengths else 0
+            for length in lengths:
+                cumulative += self.counts[length]
+                if cumulative >= needed:
+                    result = length
+                    break
+            results.append(result)
+
+        return results
+
+
+# Statistics of a corpus of "idx \t target \t src" examples. num_tokens/num_known
+# count all tokens and tokens covered by the vocab, if one was given.
+CorpusStatistics = collections.namedtuple("CorpusStatistics", ["num_examples", "target_lens",
+                                                               "src_lens", "num_tokens",
+                                                               "num_known"])
+
+
+def corpus_statistics(data_file, word_to_idx=None, unk_idx=None):
+    """
+    Compute length histograms of targets and sources, and vocab coverage, in one
+    pass over a sentence or tokenized data file
+    :param data_file: file of "idx \t target \t src" lines
+    :param word_to_idx: vocab for coverage of word tokens of a sentence file
+    :param unk_idx: id of <unk> for coverage of id tokens of a tokenized file
+    :return: CorpusStatistics
+    """
+    target_lens = LengthHistogram()
+    src_lens = LengthHistogram()
+    num_examples = 0
+    num_tokens = 0
+    num_known = 0
+
+    if unk_idx is not None:
+        unk_token = str(unk_idx)
+        is_known = lambda t: t != unk_token
+    elif word_to_idx is not None:
+        is_known = lambda t: t in word_to_idx
+    else:
+        is_known = None
 
-    num_entries = 0
-    all_src_lens = []
-    all_target_lens = []
+    with open(data_file, "rb") as f:
+        for line in f:
+            _, target, src = line.split("\t")
+            target = target.split()
+            src = src.split()
+            target_lens.add(len(target))
+            src_lens.add(len(src))
+            num_examples += 1
 
-    # Maintain frequency statistics
-    src_counter = collections.Counter()
-    target_counter = collections.Counter()
+            if is_known is not None:
+                for seq in (target, src):
+                    for t in seq:
+                        num_tokens += 1
+                        if is_known(t):
+                            num_known += 1
 
-    with open(data_file, "r") as f:
-        for line in f:
-            _, src, target = line.split("\t")
-            curr_src_len = len(src.strip().split(" "))
-            curr_target_len = len(target.strip().split(" "))
+    return CorpusStatistics(num_examples, target_lens, src_lens, num_tokens, num_known)
 
-            all_src_lens.append(curr_src_len)
-            all_target_lens.append(curr_target_len)
 
-            src_counter[curr_src_len] += 1
-            target_counter[curr_target_len] += 1
+def packed_statistics(packed, unk_idx=1, chunk_size=1 << 24):
+    """
+    Compute same statistics as corpus_statistics over packed data (see
+    create_data.write_packed_data) with array operations. Lengths come from the
+    offsets alone; coverage is counted over the token array in chunks so memory
+    stays bounded for memory-mapped files.
+    :param packed: PackedData
+    :param unk_idx: id of <unk>
+    :param chunk_size: number of tokens scanned at once
+    :return: CorpusStatistics
+    """
+    offsets = np.asarray(packed.offsets, dtype=np.int64)
+    target_lens = LengthHistogram()
+    src_lens = LengthHistogram()
+    if len(offsets):
+        target_lens.add_lengths(offsets[:, 1] - offsets[:, 0])
+        src_lens.add_lengths(offsets[:, 2] - offsets[:, 1])
 
-            sum_src_lens += curr_src_len
-            sum_target_lens += curr_target_len
+    num_tokens = len(packed.tokens)
+    num_unk = 0
+    for start in xrange(0, num_tokens, chunk_size):
+        num_unk += int(np.count_nonzero(packed.tokens[start:start + chunk_size] == unk_idx))
 
-            if curr_src_len > max_src_len:
-                max_src_len = curr_src_len
+    return CorpusStatistics(len(offsets), target_lens, src_lens, num_tokens, num_tokens - num_unk)
 
-            if curr_target_len > max_target_len:
-                max_target_len = curr_target_len
 
-            num_entries += 1
+def print_statistics(stats, thresholds=(350,), quantiles=(0.5, 0.9, 0.95, 0.99)):
+    """
+    Print max/mean lengths, quantiles, CDF values and coverage of CorpusStatistics
+    :param stats:
+    :param thresholds: lengths at which to report CDF
+    :param quantiles: fractions at which to report length quantiles
+    :return:
+    """
+    print "Num examples: ", stats.num_examples
+    for name, lens in (("source", stats.src_lens), ("target", stats.target_lens)):
+        print "Max {0} length: ".format(name), lens.max
+        print "Avg {0} length: ".format(name), lens.mean()
+        for q, length in zip(quantiles, lens.quantiles(quantiles)):
+            print "{0} length quantile {1}: {2}".format(name.capitalize(), q, length)
+        get_cdf(thresholds, lens.counts)
 
-    print "Max source length: ", max_src_len
-    print "Max target length: ", max_target_len
+    if stats.num_tokens:
+        print "Vocab coverage: {0} of {1} tokens ({2})".format(
+            stats.num_known, stats.num_tokens, float(stats.num_known) / stats.num_tokens)
 
-    print "Avg source length: ", sum_src_lens / num_entries
-    print "Avg target length: ", sum_target_lens / num_entries
 
+def compute_data_len(data_file, thresholds=(350,), quantiles=(0.5, 0.9, 0.95, 0.99)):
+    """
+    Compute max, average, quantiles and CDF of src and target sequence lengths for data file
+    :param data_file:
+    :param thresholds: lengths at which to report CDF
+    :param quantiles: fractions at which to report length quantiles
+    :return: CorpusStatistics
+    """
+    stats = corpus_statistics(data_file)
+    print_statistics(stats, thresholds, quantiles)
 
-    threshold = 350
-    get_cdf(threshold, src_counter)
-    get_cdf(threshold, target_counter)
+    return stats
 
 
-def get_cdf(threshold, freq_map):
-    num_utterances = 0
-    for  u_len, count in freq_map.iteritems():
-        if u_len < threshold:
-            num_utterances += count
+def get_cdf(thresholds, freq_map):
+    """
+    Print and return fraction of lengths in freq_map below each threshold
+    :param thresholds: threshold or list of thresholds
+    :param freq_map: Counter mapping length to frequency
+    :return: CDF value, or list of values if a list of thresholds was given
+    """
+    single = isinstance(thresholds, (int, long))
+    if single:
+        thresholds = [thresholds]
 
     total = sum(freq_map.values())
     print "Total: ", total
-    cdf = float(num_utterances) / total
-    print "CDF value for threshold {0}: {1}".format(threshold,
-                                                    str(cdf))
+    cdfs = []
+    for threshold in thresholds:
+        num_utterances = sum(count for u_len, count in freq_map.iteritems() if u_len < threshold)
+        cdf = float(num_utterances) / total if total else 0.0
+        print "CDF value for threshold {0}: {1}".format(threshold,
+                                                        str(cdf))
+        cdfs.append(cdf)
+
+    return cdfs[0] if single else cdfs
 
 
 def gen_histogram(n_bins, vec, title, xlabel, ylabel, filename):
@@ -0,0 +1,362 @@
+import bisect
+import cPickle as pickle
+import json
+import numpy as np
+import os
+import os.path
+import struct
+
+"""
+Binary store of dialogues as length-prefixed pickled records with an index of
+record offsets, so dialogues can be streamed, read by id and appended without
+unpickling the whole collection.
+"""
+
+# First bytes of every store file, used to tell stores from whole-list pickles
+store_magic = "DLGSTORE1\n"
+# Little-endian unsigned 64-bit record length prefix
+record_header = struct.Struct("<Q")
+# Little-endian 64-bit record offsets of index file
+index_dtype = "<i8"
+
+
+def store_index_file(filename):
+    return filename + ".idx"
+
+
+def store_files(filename):
+    """
+    Return data and index files making up store at filename
+    :param filename:
+    :return:
+    """
+    return [filename, store_index_file(filename)]
+
+
+def is_dialogue_store(filename):
+    """
+    Return whether filename is a DialogueStore rather than a pickled list
+    :param filename:
+    :return:
+    """
+    with open(filename, "rb") as f:
+        return f.read(len(store_magic)) == store_magic
+
+
+class DialogueStore(object):
+    """
+    Dialogues of a store file, indexed by position of insertion. The index holds one
+    64-bit offset per dialogue and is the only part kept in memory. Appended records
+    are indexed on disk on flush or close, after their data, so an interrupted
+    writer never leaves index entries past the end of the data.
+    mode "r" opens an existing store for reading, "w" creates an empty store and "a"
+    opens a store (created if missing) for reading and appending.
+    """
+
+    def __init__(self, filename, mode="r"):
+        self.filename = filename
+        self.mode = mode
+        # Offsets of indexed records, and of records appended since last flush
+        self.offsets = np.zeros(0, dtype=index_dtype)
+        self.pending = []
+
+        if mode == "w" or (mode == "a" and not os.path.exists(filename)):
+            with open(filename, "wb") as f:
+                f.write(store_magic)
+            with open(store_index_file(filename), "wb"):
+                pass
+        elif not is_dialogue_store(filename):
+            raise ValueError("Not a dialogue store: {0}".format(filename))
+
+        with open(store_index_file(filename), "rb") as f:
+            index_data = f.read()
+        self.offsets = np.frombuffer(index_data[:len(index_data) - len(index_data) % 8],
+                                     dtype=index_dtype)
+
+        if mode == "r":
+            self.data_file = open(filename, "rb")
+            self.index_file = None
+        else:
+            self.data_file = open(filename, "r+b")
+            self.index_file = open(store_index_file(filename), "r+b")
+            # Drop records written after the last indexed one, e.g. by an interrupted append
+            self.end = self._end()
+            self.data_file.seek(self.end)
+            self.data_file.truncate()
+            self.index_file.seek(len(self.offsets) * self.offsets.itemsize)
+            self.index_file.truncate()
+
+    def _end(self):
+        if not len(self.offsets):
+            return len(store_magic)
+        last = int(self.offsets[-1])
+        self.data_file.seek(last)
+        size, = record_header.unpack(self.data_file.read(record_header.size))
+        return last + record_header.size + size
+
+    def _offset(self, d_idx):
+        if d_idx < 0:
+            d_idx += len(self)
+        if d_idx < 0 or d_idx >= len(self):
+            raise IndexError("Dialogue id out of range: {0}".format(d_idx))
+        if d_idx < len(self.offsets):
+            return int(self.offsets[d_idx])
+        return self.pending[d_idx - len(self.offsets)]
+
+    @staticmethod
+    def _read_record(f):
+        size, = record_header.unpack(f.read(record_header.size))
+        return pickle.loads(f.read(size))
+
+    def __len__(self):
+        return len(self.offsets) + len(self.pending)
+
+    def __getitem__(self, d_idx):
+        """
+        Return dialogue with given id
+        :param d_idx:
+        :return:
+        """
+        self.data_file.seek(self._offset(d_idx))
+        return self._read_record(self.data_file)
+
+    def __iter__(self):
+        """
+        Stream dialogues in id order, reading records sequentially with a file
+        handle of its own so random access may interleave with iteration
+        :return:
+        """
+        num_dialogues = len(self)
+        if self.index_file is not None:
+            self.data_file.flush()
+
+        with open(self.filename, "rb") as f:
+            f.seek(len(store_magic))
+            for _ in xrange(num_dialogues):
+                yield self._read_record(f)
+
+    def append(self, dialogue):
+        """
+        Append dialogue, returning its id
+        :param dialogue: list of (user, system) exchanges
+        :return:
+        """
+        data = pickle.dumps(dialogue, pickle.HIGHEST_PROTOCOL)
+        offset = self.end
+
+        self.data_file.seek(offset)
+        self.data_file.write(record_header.pack(len(data)) + data)
+        self.end = offset + record_header.size + len(data)
+        self.pending.append(offset)
+
+        return len(self) - 1
+
+    def extend(self, dialogues):
+        for dialogue in dialogues:
+            self.append(dialogue)
+
+    def flush(self):
+        """
+        Write appended records, then their index entries
+        :return:
+        """
+        if self.index_file is None or not self.pending:
+            return
+        self.data_file.flush()
+        pending = np.array(self.pending, dtype=index_dtype)
+        self.index_file.seek(len(self.offsets) * self.offsets.itemsize)
+        self.index_file.write(pending.tostring())
+        self.index_file.flush()
+        self.offsets = np.concatenate([self.offsets, pending])
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.data_file.close()
+        if self.index_file is not None:
+            self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_dialogue_store(dialogues, filename):
+    """
+    Write iterable of dialogues to a new store
+    :param dialogues:
+    :param filename:
+    :return: number of dialogues written
+    """
+    with DialogueStore(filename, "w") as store:
+        store.extend(dialogues)
+        return len(store)
+
+
+def is_dialogue_manifest(filename):
+    """
+    Return whether filename is a manifest written by write_dialogue_manifest
+    :param filename:
+    :return:
+    """
+    with open(filename, "rb") as f:
+        return f.read(1) == "{"
+
+
+def load_dialogues(filename):
+    """
+    Open dialogues of a DialogueStore or manifest, or load a list pickled by earlier
+    versions of extract_dialogues. All support len, indexing by id and iteration.
+    :param filename:
+    :return:
+    """
+    if is_dialogue_store(filename):
+        return DialogueStore(filename)
+    if is_dialogue_manifest(filename):
+        return ConcatDialogues.from_manifest(filename)
+
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+def count_dialogues(filename):
+    """
+    Return number of dialogues in file, read from the index of stores and manifests
+    :param filename:
+    :return:
+    """
+    if is_dialogue_store(filename):
+        return os.path.getsize(store_index_file(filename)) // np.dtype(index_dtype).itemsize
+    if is_dialogue_manifest(filename):
+        with open(filename, "rb") as f:
+            return sum(source["count"] for source in json.load(f)["sources"])
+
+    return len(load_dialogues(filename))
+
+
+class ConcatDialogues(object):
+    """
+    Dialogues of several files presented as one dataset without copying them. Global
+    dialogue ids follow the order of the sources, and sources are only opened
+    when first read.
+    """
+
+    def __init__(self, sources, splits, counts):
+        """
+        :param sources: list of dialogue files (stores, pickles or manifests)
+        :param splits: name of split of each source, e.g. "train"
+        :param counts: number of dialogues of each source
+        """
+        self.sources = list(sources)
+        self.splits = list(splits)
+        self.counts = list(counts)
+        self.dialogues = [None] * len(self.sources)
+
+        # Global id of first dialogue of each source
+        self.starts = []
+        total = 0
+        for count in self.counts:
+            self.starts.append(total)
+            total += count
+        self.total = total
+
+    @classmethod
+    def from_manifest(cls, manifest_file):
+        """
+        Open manifest written by write_dialogue_manifest. Source paths are relative
+        to the manifest's directory.
+        :param manifest_file:
+        :return:
+        """
+        with open(manifest_file, "rb") as f:
+            manifest = json.load(f)
+
+        base_dir = os.path.dirname(os.path.abspath(manifest_file))
+        sources = manifest["sources"]
+        return cls([os.path.join(base_dir, s["file"]).encode("utf-8") for s in sources],
+                   [s["split"] for s in sources], [s["count"] for s in sources])
+
+    def _source(self, i):
+        if self.dialogues[i] is None:
+            self.dialogues[i] = load_dialogues(self.sources[i])
+        return self.dialogues[i]
+
+    def locate(self, d_idx):
+        """
+        Return (source number, id within source) of global dialogue id
+        :param d_idx:
+        :return:
+        """
+        if d_idx < 0:
+            d_idx += self.total
+        if d_idx < 0 or d_idx >= self.total:
+            raise IndexError("Dialogue id out of range: {0}".format(d_idx))
+
+        i = bisect.bisect_right(self.starts, d_idx) - 1
+        # Skip sources without dialogues, which share their start with the next one
+        while self.counts[i] == 0:
+            i += 1
+        return i, d_idx - self.starts[i]
+
+    def get_split(self, d_idx):
+        """
+        Return name of split dialogue with given global id comes from
+        :param d_idx:
+        :return:
+        """
+        return self.splits[self.locate(d_idx)[0]]
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, d_idx):
+        i, local_idx = self.locate(d_idx)
+        return self._source(i)[local_idx]
+
+    def __iter__(self):
+        for i in xrange(len(self.sources)):
+            if self.counts[i]:
+                for dialogue in self._source(i):
+                    yield dialogue
+
+
+def write_dialogue_manifest(sources, splits, manifest_file):
+    """
+    Write manifest presenting dialogue files as one concatenated dataset, recording
+    split and number of dialogues of each source
+    :param sources: list of dialogue files
+    :param splits: name of split of each source
+    :param manifest_file:
+    :return: number of dialogues of all sources
+    """
+    with open(manifest_file, "wb") as f:
+        json.dump({"sources": []}, f)
+
+    for source, split in zip(sources, splits):
+        add_dialogue_source(manifest_file, source, split)
+
+    return count_dialogues(manifest_file)
+
+
+def add_dialogue_source(manifest_file, source, split):
+    """
+    Append dialogue file to manifest, after dialogues of the existing sources
+    :param manifest_file:
+    :param source:
+    :param split:
+    :return: global id of first dialogue of source
+    """
+    with open(manifest_file, "rb") as f:
+        manifest = json.load(f)
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    start = sum(s["count"] for s in manifest["sources"])
+    manifest["sources"].append({"file": os.path.relpath(os.path.abspath(source), base_dir),
+                                "split": split, "count": count_dialogues(source)})
+
+    with open(manifest_file, "wb") as f:
+        json.dump(manifest, f, indent=2)
+
+    return start
@@ -0,0 +1,315 @@
+import collections
+import hashlib
+import inspect
+import json
+import os
+import os.path
+import re
+import shutil
+import sys
+
+"""
+Runner for multi-stage data pipelines which caches the outputs of each stage
+under a key hashed from its input file contents, parameters and code, so stages
+whose inputs did not change are restored from cache instead of recomputed.
+"""
+
+# name: stage name, fn: function run by stage, args/kwargs: arguments of fn,
+# inputs: files read by stage, outputs: files written by stage
+Stage = collections.namedtuple("Stage", ["name", "fn", "args", "kwargs", "inputs", "outputs"])
+
+# Argument of a stage computed as fn(*args) right before the stage runs, e.g. to load
+# a vocab file written by an earlier stage
+Deferred = collections.namedtuple("Deferred", ["fn", "args"])
+
+
+def hash_file(path, file_hashes):
+    """
+    Return sha1 of file contents, memoized in file_hashes by path, size and mtime
+    :param path:
+    :param file_hashes: dict mapping path to [size, mtime, sha1]
+    :return:
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    memo = file_hashes.get(path)
+    if memo is not None and memo[0] == stat.st_size and memo[1] == stat.st_mtime:
+        return memo[2]
+
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), ""):
+            sha.update(chunk)
+
+    file_hashes[path] = [stat.st_size, stat.st_mtime, sha.hexdigest()]
+    return sha.hexdigest()
+
+
+def param_repr(value):
+    """
+    Return stable string representation of a stage argument for hashing
+    :param value:
+    :return:
+    """
+    if isinstance(value, Deferred):
+        return "Deferred({0}, {1})".format(param_repr(value.fn), param_repr(value.args))
+    if inspect.isfunction(value) or inspect.isclass(value):
+        return "{0}.{1}".format(value.__module__, value.__name__)
+    if isinstance(value, dict):
+        return "{" + ", ".join("{0}: {1}".format(param_repr(k), param_repr(value[k]))
+                               for k in sorted(value)) + "}"
+    if isinstance(value, (set, frozenset)):
+        return "set([" + ", ".join(sorted(param_repr(v) for v in value)) + "])"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(param_repr(v) for v in value) + "]"
+    return repr(value)
+
+
+def _source_dir(obj):
+    try:
+        return os.path.dirname(os.path.abspath(inspect.getsourcefile(obj)))
+    except TypeError:
+        # Builtin or C extension
+        return None
+
+
+def _code_names(code):
+    """
+    Return names of globals and attributes used by code object and nested ones
+    :param code:
+    :return:
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names.update(_code_names(const))
+
+    return names
+
+
+def _referenced_names(obj):
+    """
+    Return (module globals, names used, default argument values) of function or
+    methods of class
+    :param obj:
+    :return:
+    """
+    if inspect.isclass(obj):
+        fns = []
+        for value in vars(obj).values():
+            # Unwrap staticmethod/classmethod
+            value = getattr(value, "__func__", value)
+            if inspect.isfunction(value):
+                fns.append(value)
+        module_globals = vars(sys.modules[obj.__module__])
+    else:
+        fns = [obj]
+        module_globals = obj.__globals__
+
+    names = set()
+    defaults = []
+    for fn in fns:
+        names.update(_code_names(fn.__code__))
+        defaults.extend(fn.__defaults__ or ())
+
+    return module_globals, names, defaults
+
+
+_constant_types = (basestring, int, long, float, bool, list, tuple, dict, set, frozenset,
+                   type(None))
+_regex_type = type(re.compile(""))
+
+
+def _value_version(value, code_dirs, pending):
+    """
+    Return string versioning a global or default argument value, adding the
+    functions and classes from code_dirs it depends on to pending
+    :param value:
+    :param code_dirs:
+    :param pending:
+    :return: string, or None if value does not depend on code of code_dirs
+    """
+    if inspect.isfunction(value) or inspect.isclass(value):
+        if _source_dir(value) in code_dirs:
+            pending.append(value)
+        return None
+    if isinstance(value, _constant_types):
+        # Module-level constants such as regex patterns
+        return param_repr(value)
+    if isinstance(value, _regex_type):
+        # Compiled pattern, e.g. built from a constant by a module-level call
+        return repr((value.pattern, value.flags))
+    if _source_dir(type(value)) in code_dirs and hasattr(value, "__dict__"):
+        # Instance of a class of the repo, e.g. a module-level Tokenizer: version its
+        # class and the attributes set from its constructor arguments. Attributes
+        # holding other objects (e.g. caches) only contribute their class.
+        pending.append(type(value))
+        attrs = {}
+        for attr, attr_value in vars(value).items():
+            if type(attr_value).__module__ == "__builtin__" or \
+                    isinstance(attr_value, _regex_type):
+                attrs[attr] = _value_version(attr_value, code_dirs, pending)
+            elif _source_dir(type(attr_value)) in code_dirs:
+                pending.append(type(attr_value))
+            else:
+                _value_version(attr_value, code_dirs, pending)
+        return "{0}.{1}({2})".format(type(value).__module__, type(value).__name__,
+                                     param_repr(attrs))
+    return None
+
+
+def get_code_version(fns):
+    """
+    Return hash of source of given functions and of the functions, classes,
+    constants and instances from the same directory they reference by name or
+    as default argument values, transitively. Edits to other code of the same
+    modules do not change the version.
+    :param fns: list of functions
+    :return:
+    """
+    code_dirs = set(_source_dir(fn) for fn in fns)
+    pending = list(fns)
+    seen = {}
+
+    while pending:
+        obj = pending.pop()
+        name = "{0}.{1}".format(obj.__module__, obj.__name__)
+        if name in seen:
+            continue
+        try:
+            seen[name] = inspect.getsource(obj)
+        except (IOError, TypeError):
+            # No source found, e.g. for namedtuple classes
+            seen[name] = repr(getattr(obj, "_fields", None))
+
+        module_globals, names, defaults = _referenced_names(obj)
+        for ref_name in sorted(names):
+            if ref_name not in module_globals:
+                continue
+            version = _value_version(module_globals[ref_name], code_dirs, pending)
+            if version is not None:
+                seen["{0}.{1}".format(obj.__module__, ref_name)] = version
+
+        for i, value in enumerate(defaults):
+            version = _value_version(value, code_dirs, pending)
+            if version is not None:
+                seen["{0}:default{1}".format(name, i)] = version
+
+    sha = hashlib.sha1()
+    for name in sorted(seen):
+        sha.update(name + "\0" + seen[name] + "\0")
+
+    return sha.hexdigest()
+
+
+def get_stage_key(stage, file_hashes):
+    """
+    Return key of stage hashed from its name, inputs contents, parameters and code
+    :param stage:
+    :param file_hashes: memo of hash_file
+    :return:
+    """
+    fns = [stage.fn] + [a.fn for a in list(stage.args) + stage.kwargs.values()
+                        if isinstance(a, Deferred)]
+    key = {
+        "name": stage.name,
+        "inputs": [hash_file(path, file_hashes) for path in stage.inputs],
+        "params": param_repr([stage.args, stage.kwargs, stage.outputs]),
+        "code": get_code_version(fns),
+    }
+
+    return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+
+def _copy(src, dst):
+    # Copy rather than hard link, as stages may modify their outputs in place
+    # (e.g. inserting into a DB), which would also modify the cached artifact
+    if os.path.exists(dst):
+        os.remove(dst)
+    shutil.copyfile(src, dst)
+
+
+def _resolve(value):
+    return value.fn(*value.args) if isinstance(value, Deferred) else value
+
+
+def run_stage(stage, cache_dir, file_hashes):
+    """
+    Run stage unless an artifact for its key exists, in which case its outputs
+    are restored from cache. Existing outputs are removed before running so that
+    stages write new files rather than modify cached artifacts.
+    :param stage:
+    :param cache_dir:
+    :param file_hashes: memo of hash_file
+    :return: whether stage was run
+    """
+    key = get_stage_key(stage, file_hashes)
+    artifact_dir = os.path.join(cache_dir, "artifacts", key)
+    manifest_file = os.path.join(artifact_dir, "manifest.json")
+
+    if os.path.exists(manifest_file):
+        with open(manifest_file, "rb") as f:
+            manifest = json.load(f)
+
+        for i, (path, sha) in enumerate(manifest["outputs"]):
+            if not os.path.exists(path) or hash_file(path, file_hashes) != sha:
+                _copy(os.path.join(artifact_dir, str(i)), path)
+
+        print "Stage {0}: cached ({1})".format(stage.name, key[:10])
+        return False
+
+    print "Stage {0}: running ({1})".format(stage.name, key[:10])
+    for path in stage.outputs:
+        if os.path.exists(path):
+            os.remove(path)
+
+    stage.fn(*[_resolve(a) for a in stage.args],
+             **dict((k, _resolve(v)) for k, v in stage.kwargs.items()))
+
+    # Write manifest last so an interrupted stage is never treated as cached
+    tmp_dir = artifact_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    outputs = []
+    for i, path in enumerate(stage.outputs):
+        _copy(path, os.path.join(tmp_dir, str(i)))
+        outputs.append((path, hash_file(path, file_hashes)))
+
+    with open(os.path.join(tmp_dir, "manifest.json"), "wb") as f:
+        json.dump({"name": stage.name, "outputs": outputs}, f)
+    if os.path.exists(artifact_dir):
+        shutil.rmtree(artifact_dir)
+    os.rename(tmp_dir, artifact_dir)
+
+    return True
+
+
+def run_pipeline(stages, cache_dir):
+    """
+    Run stages in order, reusing cached outputs of stages whose inputs, parameters
+    and code did not change
+    :param stages: list of Stage
+    :param cache_dir: directory holding artifacts and file hash memo
+    :return: list of names of stages that were run
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    hashes_file = os.path.join(cache_dir, "file_hashes.json")
+    file_hashes = {}
+    if os.path.exists(hashes_file):
+        with open(hashes_file, "rb") as f:
+            file_hashes = json.load(f)
+
+    ran = []
+    try:
+        for stage in stages:
+            if run_stage(stage, cache_dir, file_hashes):
+                ran.append(stage.name)
+    finally:
+        with open(hashes_file, "wb") as f:
+            json.dump(file_hashes, f)
+
+    return ran
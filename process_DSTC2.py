@@ -1,29 +1,30 @@
 import collections
 import dill as pickle
+import itertools
+import multiprocessing
 import sqlite3
 import json
 import os
 import os.path
 import pprint
 
-from create_data import tokenize_data, gen_data_split
-from data_utils import extract_text_vocab, compute_data_len
+from create_data import tokenize_data, tokenize_example, gen_data_split, gen_data_split_streaming
+from dialogue_store import DialogueStore, load_dialogues, store_files, write_dialogue_store, \
+    write_dialogue_manifest
+from data_utils import compute_data_len, build_matcher, find_matches, process_file_parallel, \
+    ContextWindow, Tokenizer, LRUCache, canonical_re_pattern
+from pipeline import Stage, Deferred
+from restaurant_kb import as_restaurant_kb
+from vocab import build_freq_vocab, read_vocab_file
 
 
 def get_entity_name_values(db_file):
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-
-    entity_names = ['price', 'cuisine', 'location']
-    name_to_values = collections.defaultdict(set)
-
-    with open(db_file, 'r') as f:
-        for name in entity_names:
-            c.execute("SELECT {0} FROM Restaurants".format(name))
-            values = [v[0] for v in c.fetchall() if v[0] != ""]
-            name_to_values[name] = set(values)
-
-    return name_to_values
+    """
+    Return dict mapping price, cuisine and location to sets of their non-empty values
+    :param db_file: DB file or RestaurantKB
+    :return:
+    """
+    return as_restaurant_kb(db_file).entity_name_values()
 
 
 def get_canonicalized_entities(entities):
@@ -40,72 +41,364 @@ def get_canonicalized_entities(entities):
     return canonicalized
 
 
-def canonicalize(utterance, entities):
+# Surface phrases that are rewritten before entity matching
+special_phrases = {"moderately priced": "moderate"}
+
+def build_entity_index(entities):
     """
-    Canonicalize input utterance
-    :param input:
-    :param entity_names:
+    Build index mapping the first token of every entity surface form to the
+    (phrase tokens, canonical form) pairs starting with it, longest phrase first.
+    Underscore values (e.g. modern_european) are also indexed by their spaced form.
+    :param entities: dict mapping entity name to set of values
     :return:
     """
-    # Hard-code special cases
-    utterance = utterance.replace("moderately priced", "moderate")
-    utterance_tokens = utterance.split(" ")
-
-    # Canonicalize the rest
+    phrase_to_canonical = {}
     for name, values in entities.items():
         for v in values:
-            for idx, tok in enumerate(utterance_tokens):
-                # Replace if get string match
-                if v == tok:
-                    # Separating by '*' character so regex doesn't split canonical form
-                    utterance_tokens[idx] = "({0}*{1})".format(name, v)
-                    #utterance = utterance.replace(v, "({0}*{1})".format(name, v))
+            canonical = "({0}*{1})".format(name, v)
+            # First (name, value) seen wins, as in the original token scan
+            phrase_to_canonical.setdefault((v,), canonical)
+            if "_" in v:
+                spaced = tuple(t for t in v.split("_") if t != "")
+                if len(spaced) > 1:
+                    phrase_to_canonical.setdefault(spaced, canonical)
+
+    for phrase, replacement in special_phrases.items():
+        canonical = phrase_to_canonical.get((replacement,), replacement)
+        phrase_to_canonical[tuple(phrase.split(" "))] = canonical
+
+    entity_index = collections.defaultdict(list)
+    for phrase, canonical in phrase_to_canonical.items():
+        entity_index[phrase[0]].append((phrase, canonical))
+
+    for candidates in entity_index.values():
+        candidates.sort(key=lambda c: len(c[0]), reverse=True)
+
+    return dict(entity_index)
+
+
+def canonicalize(utterance, entities, entity_index=None, cache=None, cache_max_len=1000):
+    """
+    Canonicalize input utterance in a single left-to-right pass over its tokens
+    :param utterance:
+    :param entities: dict mapping entity name to set of values
+    :param entity_index: prebuilt index from build_entity_index (built from entities if None)
+    :param cache: optional LRUCache of canonicalized utterances
+    :param cache_max_len: max length of utterances memoized in cache, so long unique
+    dialogue histories do not evict short repeated utterances
+    :return:
+    """
+    if cache is not None and len(utterance) > cache_max_len:
+        cache = None
+
+    if cache is not None:
+        canonical = cache.get(utterance)
+        if canonical is not None:
+            return canonical
+
+    if entity_index is None:
+        entity_index = build_entity_index(entities)
+
+    # Match the last token of a raw line without its newline, added back below
+    newline = "\n" if utterance.endswith("\n") else ""
+    utterance_tokens = utterance[:len(utterance) - len(newline)].split(" ")
+    num_tokens = len(utterance_tokens)
+    canonical_tokens = []
+
+    idx = 0
+    while idx < num_tokens:
+        tok = utterance_tokens[idx]
+        match = None
+        for phrase, canonical in entity_index.get(tok, ()):
+            end = idx + len(phrase)
+            if end <= num_tokens and tuple(utterance_tokens[idx:end]) == phrase:
+                match = canonical
+                break
+
+        if match is None:
+            canonical_tokens.append(tok)
+            idx += 1
+        else:
+            # Separating by '*' character so regex doesn't split canonical form
+            canonical_tokens.append(match)
+            idx += len(phrase)
 
-    return " ".join(utterance_tokens)
+    canonical = " ".join(canonical_tokens) + newline
+    if cache is not None:
+        cache.put(utterance, canonical)
 
+    return canonical
 
-def entity_link(data_file, out_file, entities):
+
+def entity_link_example(example, entities, entity_index, cache=None):
+    """
+    Canonicalize both utterances of one "d_num \t src \t target" example line
+    :param example:
+    :param entities:
+    :param entity_index: index from build_entity_index
+    :param cache: optional LRUCache of canonicalized utterances
+    :return: tuple with entity-linked line
+    """
+    d_num, src, target = example.split("\t")
+
+    src_new = canonicalize(src, entities, entity_index, cache)
+    target_new = canonicalize(target, entities, entity_index, cache)
+
+    return (d_num + "\t" + src_new + "\t" + target_new,)
+
+
+def entity_link(data_file, out_file, entities, cache_size=10000):
     """ Given requestable slots above, replace attributes with entity-linked
      format. (entity_name, entity_value) where entity_name
     :param data:
+    :param cache_size: max number of canonicalized utterances memoized
     :return:
     """
+    entity_index = build_entity_index(entities)
+    cache = LRUCache(cache_size)
     f_out = open(out_file, "w")
 
     with open(data_file, "r") as f:
         # Process each example
         for example in f:
-            d_num, src, target = example.split("\t")
+            f_out.write(entity_link_example(example, entities, entity_index, cache)[0])
 
-            src_new = canonicalize(src, entities)
-            target_new = canonicalize(target, entities)
+    f_out.close()
+    print "Canonicalization cache: ", cache.stats()
 
-            f_out.write(d_num + "\t" + src_new + "\t" + target_new)
 
-    f_out.close()
+def entity_link_parallel(data_file, out_file, entities, num_workers=None, cache_size=10000):
+    """
+    Same as entity_link but link chunks of data file in a pool of processes,
+    merging outputs in original order
+    :param data_file:
+    :param out_file:
+    :param entities:
+    :param num_workers: number of processes (defaults to number of cpus)
+    :param cache_size: max number of canonicalized utterances memoized per process
+    :return:
+    """
+    process_file_parallel(data_file, [out_file], entity_link_example,
+                          (entities, build_entity_index(entities), LRUCache(cache_size)),
+                          num_workers)
 
 
-def extract_dialogues(filename, pkl_filename, restaurant_db):
+def link_and_tokenize_example(example, entities, entity_index, tokenizer, cache=None,
+                              keep_canonical=False):
     """
-    Extract dialogues from given filename as list of lists
-    :param filename:
+    Entity link one example line, then tokenize it, without writing the linked line
+    :param example:
+    :param entities:
+    :param entity_index: index from build_entity_index
+    :param tokenizer: Tokenizer with vocab and canonical pattern
+    :param cache: optional LRUCache of canonicalized utterances
+    :param keep_canonical: also return entity-linked line
+    :return: (tokenized line, parallel sentence line[, entity-linked line])
+    """
+    can_line = entity_link_example(example, entities, entity_index, cache)[0]
+    tok_line, sent_line = tokenize_example(can_line, tokenizer)
+
+    if keep_canonical:
+        return tok_line, sent_line, can_line
+    return tok_line, sent_line
+
+
+def link_and_tokenize(data_file, tok_outfile, p_sent_file, entities, vocab_word_to_idx,
+                      re_patterns=canonical_re_pattern, can_file=None, cache_size=10000):
+    """
+    Same outputs as entity_link followed by tokenize_data on its output, in a single
+    read of data file
+    :param data_file:
+    :param tok_outfile: output file for tokens of entity-linked data
+    :param p_sent_file: output file with text of entity-linked data
+    :param entities:
+    :param vocab_word_to_idx:
+    :param re_patterns: pattern for tokenizing entity-linked text
+    :param can_file: optional output file for entity-linked lines, as written by entity_link
+    :param cache_size: max number of canonicalized and of tokenized utterances memoized
     :return:
     """
-    dialogues = []
+    entity_index = build_entity_index(entities)
+    cache = LRUCache(cache_size)
+    tokenizer = Tokenizer(re_patterns, vocab_word_to_idx, cache_size=cache_size)
+    keep_canonical = can_file is not None
+    out_files = [open(name, "wb") for name in [tok_outfile, p_sent_file, can_file]
+                 if name is not None]
+
+    with open(data_file, "rb") as f:
+        for example in f:
+            lines = link_and_tokenize_example(example, entities, entity_index, tokenizer, cache,
+                                              keep_canonical)
+            for out_file, line in zip(out_files, lines):
+                out_file.write(line)
+
+    for out_file in out_files:
+        out_file.close()
+
+    print "Canonicalization cache: ", cache.stats()
+    print "Tokenizer cache: ", tokenizer.cache.stats()
+
+
+def link_and_tokenize_parallel(data_file, tok_outfile, p_sent_file, entities, vocab_word_to_idx,
+                               re_patterns=canonical_re_pattern, can_file=None, num_workers=None,
+                               cache_size=10000):
+    """
+    Same as link_and_tokenize but process chunks of data file in a pool of processes,
+    merging outputs in original order
+    :param num_workers: number of processes (defaults to number of cpus)
+    :return:
+    """
+    out_files = [tok_outfile, p_sent_file] + ([can_file] if can_file is not None else [])
+    process_file_parallel(data_file, out_files, link_and_tokenize_example,
+                          (entities, build_entity_index(entities),
+                           Tokenizer(re_patterns, vocab_word_to_idx, cache_size=cache_size),
+                           LRUCache(cache_size), can_file is not None),
+                          num_workers)
+
+
+class DialogueSession(object):
+    """
+    Source ids of a live dialogue, identical to those of the offline pipeline
+    (create_dialogues_file, tokenize_data, entity_link and tokenize_data with the
+    canonical pattern) but computed incrementally as utterances are appended.
+    Entity phrases may span utterances, so canonicalization decisions starting in
+    the last max_phrase_len - 1 tokens are kept pending and redone on the next append.
+    """
 
-    # Create DB
+    def __init__(self, entity_index, tokenizer, canonical_tokenizer, max_len=None):
+        """
+        :param entity_index: index from build_entity_index
+        :param tokenizer: Tokenizer with re_patterns
+        :param canonical_tokenizer: Tokenizer with canonical_re_pattern and vocab
+        :param max_len: max number of source ids, older ids are dropped
+        """
+        self.entity_index = entity_index
+        self.tokenizer = tokenizer
+        self.canonical_tokenizer = canonical_tokenizer
+        self.max_len = max_len
+        self.max_phrase_len = max([len(phrase) for candidates in entity_index.values()
+                                   for phrase, _ in candidates] or [1])
+
+        # Tokens from position token_offset on, of which only those of pending
+        # steps (and not yet parsed ones) are kept
+        self.tokens = []
+        self.token_offset = 0
+        self.num_tokens = 0
+        # (start position, number of ids) of canonicalization steps that may change
+        self.pending = collections.deque()
+        self.ids = []
+
+    def _rollback(self):
+        # A step starting at position p only looked at tokens before p + max_phrase_len
+        last_final = self.num_tokens - self.max_phrase_len
+        restart = self.num_tokens
+        while self.pending and self.pending[-1][0] > last_final:
+            start, num_ids = self.pending.pop()
+            if num_ids:
+                del self.ids[-num_ids:]
+            restart = start
+
+        return restart
+
+    def append(self, utterance):
+        """
+        Append user or system utterance to dialogue
+        :param utterance:
+        :return: source ids including utterance, as from source_ids
+        """
+        restart = self._rollback()
+        self.tokens.extend(self.tokenizer.tokens(utterance))
+        self.num_tokens = self.token_offset + len(self.tokens)
+
+        # Same single pass as canonicalize, from first pending position
+        tokens = self.tokens
+        offset = self.token_offset
+        idx = restart
+        while idx < self.num_tokens:
+            tok = tokens[idx - offset]
+            match = None
+            for phrase, canonical in self.entity_index.get(tok, ()):
+                end = idx + len(phrase)
+                if end <= self.num_tokens and tuple(tokens[idx - offset:end - offset]) == phrase:
+                    match = canonical
+                    break
+
+            piece_ids = self.canonical_tokenizer.ids(tok if match is None else match)
+            self.pending.append((idx, len(piece_ids)))
+            self.ids.extend(piece_ids)
+            idx += 1 if match is None else len(phrase)
+
+        # Forget tokens and steps that can no longer change
+        last_final = self.num_tokens - self.max_phrase_len
+        while self.pending and self.pending[0][0] <= last_final:
+            self.pending.popleft()
+        first_needed = self.pending[0][0] if self.pending else self.num_tokens
+        del self.tokens[:first_needed - self.token_offset]
+        self.token_offset = first_needed
+
+        if self.max_len is not None:
+            # Keep ids of pending steps, which may be rolled back, plus max_len
+            keep = self.max_len + sum(num_ids for _, num_ids in self.pending)
+            if len(self.ids) > 2 * keep:
+                del self.ids[:len(self.ids) - keep]
+
+        return self.source_ids()
+
+    def source_ids(self):
+        """
+        Return list of source ids of dialogue so far, truncated on the left to max_len
+        :return:
+        """
+        if self.max_len is not None and len(self.ids) > self.max_len:
+            return self.ids[len(self.ids) - self.max_len:]
+        return list(self.ids)
+
+
+def create_restaurant_db(restaurant_db):
+    """
+    Connect to restaurant DB, creating the Restaurants table if DB does not exist
+    :param restaurant_db:
+    :return:
+    """
     if not os.path.exists(restaurant_db):
         conn = sqlite3.connect(restaurant_db)
-        c = conn.cursor()
         print "Creating DB"
-        c.execute("""CREATE TABLE Restaurants (name text unique, post_code text, cuisine text, location text,
+        conn.execute("""CREATE TABLE Restaurants (name text unique, post_code text, cuisine text, location text,
               phone text, address text, price text, rating text)""")
         conn.commit()
     else:
         conn = sqlite3.connect(restaurant_db)
-        c = conn.cursor()
+
+    return conn
+
+
+def insert_restaurants(conn, restaurants, journal_mode=None, synchronous=None):
+    """
+    Insert restaurant tuples into DB in a single transaction
+    :param conn: connection to restaurant DB
+    :param restaurants: iterable of restaurant tuples
+    :param journal_mode: optional journal_mode pragma (e.g. "MEMORY", "OFF") for build-time use
+    :param synchronous: optional synchronous pragma (e.g. "OFF") for build-time use
+    :return:
+    """
+    if journal_mode is not None:
+        conn.execute("PRAGMA journal_mode = {0}".format(journal_mode))
+    if synchronous is not None:
+        conn.execute("PRAGMA synchronous = {0}".format(synchronous))
+
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO Restaurants VALUES "
+                         "(?,?,?,?,?,?,?,?)", restaurants)
 
 
+def iter_dialogues(filename):
+    """
+    Lazily parse dialogues of given file, holding one dialogue in memory at a time.
+    A dialogue is only yielded once the blank line ending it is read.
+    :param filename:
+    :return: generator of (exchanges, api_results), where exchanges is a list of
+    (user, system) tuples and api_results a list of api result lines
+    """
     with open(filename, "r") as f:
         exchanges = []
         # (Post_code, cuisine, location, phone, address, price, rating)
@@ -115,15 +408,7 @@ def extract_dialogues(filename, pkl_filename, restaurant_db):
             # Signifies that end of dialogue has been reached so
             # output utterances
             if line == "\n":
-                dialogues.append(exchanges)
-                restaurants = process_api_results(api_results)
-
-                # Update restaurants in DB
-                if len(restaurants) != 0:
-                    for r in restaurants:
-                        c.execute("INSERT OR IGNORE INTO Restaurants VALUES "
-                                  "(?,?,?,?,?,?,?,?)", r)
-                        conn.commit()
+                yield exchanges, api_results
 
                 exchanges = []
                 api_results = []
@@ -142,9 +427,122 @@ def extract_dialogues(filename, pkl_filename, restaurant_db):
                 exchanges.append((user, system))
 
 
+def parse_dialogues(filename):
+    """
+    Parse dialogues of given file along with restaurants found in its api results
+    :param filename:
+    :return: list of dialogues, list of restaurant tuples in order of appearance
+    """
+    dialogues = []
+    all_restaurants = []
+
+    for exchanges, api_results in iter_dialogues(filename):
+        dialogues.append(exchanges)
+        all_restaurants.extend(process_api_results(api_results))
+
+    return dialogues, all_restaurants
+
+
+def extract_dialogues(filename, pkl_filename, restaurant_db, journal_mode=None, synchronous=None,
+                      store=False):
+    """
+    Extract dialogues from given filename as list of lists
+    :param filename:
+    :param journal_mode: optional journal_mode pragma used while ingesting restaurants
+    :param synchronous: optional synchronous pragma used while ingesting restaurants
+    :param store: write dialogues as a DialogueStore instead of a pickled list, so
+    that no more than one dialogue is held in memory
+    :return:
+    """
+    dialogues = DialogueStore(pkl_filename, "w") if store else []
+
+    def save_dialogues_iter_restaurants():
+        # Dialogues are saved as the DB insert consumes their restaurants, so the
+        # file is parsed in a single pass
+        for exchanges, api_results in iter_dialogues(filename):
+            dialogues.append(exchanges)
+            for restaurant in process_api_results(api_results):
+                yield restaurant
+
+    # Update restaurants in DB
+    conn = create_restaurant_db(restaurant_db)
+    insert_restaurants(conn, save_dialogues_iter_restaurants(), journal_mode, synchronous)
+    conn.close()
+
     print "Dialogues: ", len(dialogues)
-    with open(pkl_filename, "wb") as f:
+    if store:
+        dialogues.close()
+    else:
+        write_dialogues(dialogues, pkl_filename)
+
+
+def write_dialogues(dialogues, filename, store=False):
+    """
+    Write dialogues as a DialogueStore or a pickled list
+    :param dialogues: iterable of dialogues
+    :param filename:
+    :param store:
+    :return: number of dialogues written
+    """
+    if store:
+        return write_dialogue_store(dialogues, filename)
+
+    dialogues = list(dialogues)
+    with open(filename, "wb") as f:
         pickle.dump(dialogues, f)
+    return len(dialogues)
+
+
+def iter_restaurants(filename):
+    """
+    Lazily yield restaurant tuples from api results of given file
+    :param filename:
+    :return:
+    """
+    for _, api_results in iter_dialogues(filename):
+        for restaurant in process_api_results(api_results):
+            yield restaurant
+
+
+def parse_restaurants(filename):
+    """
+    Return list of restaurant tuples from api results of given file
+    :param filename:
+    :return:
+    """
+    return list(iter_restaurants(filename))
+
+
+def build_restaurant_db(filenames, restaurant_db, num_workers=1, journal_mode="MEMORY",
+                        synchronous="OFF"):
+    """
+    Populate restaurant DB from api results of all given dialogue files. Files are
+    parsed by num_workers processes and written in file order by a single writer
+    in one transaction.
+    :param filenames: list of dialogue files
+    :param restaurant_db:
+    :param num_workers: number of parser processes
+    :param journal_mode: journal_mode pragma used for the build
+    :param synchronous: synchronous pragma used for the build
+    :return:
+    """
+    conn = create_restaurant_db(restaurant_db)
+
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        file_restaurants = pool.imap(parse_restaurants, filenames)
+    else:
+        pool = None
+        # Stream restaurants straight into the DB
+        file_restaurants = itertools.imap(iter_restaurants, filenames)
+
+    insert_restaurants(conn, itertools.chain.from_iterable(file_restaurants),
+                       journal_mode, synchronous)
+    conn.close()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 
 attr_names = ['name', 'R_post_code', 'R_cuisine', 'R_location', 'R_phone', 'R_address',
@@ -196,98 +594,210 @@ def process_api_results(api_results):
 def get_all_restaurants(db):
     """
     Get a list of all restaurants in db
-    :param db:
+    :param db: DB file or RestaurantKB
+    :return:
+    """
+    return as_restaurant_kb(db).names()
+
+
+# Restaurant attributes given as arguments of an api_call, in order
+api_call_attrs = ['cuisine', 'location', 'price']
+
+def resolve_api_call(api_call, kb, cache=None):
+    """
+    Return frozenset of names of restaurants matching api_call arguments, where
+    R_* arguments match any value. Matching is case-insensitive as with LIKE.
+    :param api_call: sequence of (cuisine, location, price) api_call arguments
+    :param kb: RestaurantKB
+    :param cache: optional dict memoizing results per distinct api_call
     :return:
     """
-    conn = sqlite3.connect(db)
-    curs = conn.cursor()
-    curs.execute("SELECT name FROM Restaurants")
+    api_call = tuple(api_call)
+    if cache is not None and api_call in cache:
+        return cache[api_call]
 
-    return set([r[0] for r in curs.fetchall()])
+    if len(api_call) != len(api_call_attrs):
+        raise ValueError("Expected {0} api_call arguments, got {1}".format(
+            len(api_call_attrs), api_call))
+
+    rests = kb.lookup_names(**dict((attr, None if value in attr_names else value)
+                                   for attr, value in zip(api_call_attrs, api_call)))
+
+    if cache is not None:
+        cache[api_call] = rests
+
+    return rests
+
+
+def get_restaurant_matcher(all_restr):
+    """
+    Build matcher reporting restaurant name when either the name or its
+    underscore-to-space variant occurs in a text
+    :param all_restr: set of restaurant names
+    :return:
+    """
+    restr_patterns = []
+    for restr in all_restr:
+        if restr == "ask": continue
+        restr_clean = " ".join(restr.split("_"))
+        restr_patterns.append((restr, restr))
+        restr_patterns.append((restr_clean, restr))
+
+    return build_matcher(restr_patterns)
 
 
 def get_dialogue_restr(dialogue_file, db):
     """
     Save dict mapping from dialogue number to set of potential candidates in dialogue
     :param dialogue_file:
-    :param db:
+    :param db: DB file or RestaurantKB
     :return:
     """
-    c = sqlite3.connect(db)
-    curs = c.cursor()
-
-    with open(dialogue_file, "r") as f:
-        dialogues = pickle.load(f)
+    dialogues = load_dialogues(dialogue_file)
 
     dial_to_rests = collections.defaultdict(set)
+    kb = as_restaurant_kb(db)
+    api_cache = {}
 
     # Get restr. candidates from api_calls
     for idx, dial in enumerate(dialogues):
         dial = dial[::-1]
         for _, system in dial:
             tokens = system.split()
-            api_call = []
             # Found an api_call
             if tokens[0] == "api_call":
-                for t in tokens[1:]:
-                    if t in attr_names:
-                        api_call.append("%")
-                    else:
-                        api_call.append(t)
-
-                api_call = tuple(api_call)
-                curs.execute("SELECT * FROM Restaurants WHERE cuisine LIKE ? "
-                         "and location LIKE ? and price LIKE ?", api_call)
-                api_response = curs.fetchall()
-                rests = set([entry[0] for entry in api_response])
+                rests = resolve_api_call(tokens[1:], kb, api_cache)
 
                 # Update which restaurants map for given dialogue
-                dial_to_rests[idx] = rests
+                dial_to_rests[idx] = set(rests)
                 break
 
     # Get restr. candidates by string-matching from set of all restaurants
-    all_restr = get_all_restaurants(db)
+    restr_matcher = get_restaurant_matcher(kb.names())
     for idx, dial in enumerate(dialogues):
-        dial_text = reduce(lambda m,n: m + " " + n[0] + " " + n[1], dial, "")
-        dial_restr = set()
-        for restr in all_restr:
-            if restr == "ask": continue
-            restr_clean = " ".join(restr.split("_"))
-            if restr_clean in dial_text or restr in dial_text:
-                dial_restr.add(restr)
-
-        dial_to_rests[idx].update(dial_restr)
+        dial_text = "".join(" " + user + " " + system for user, system in dial)
+        dial_to_rests[idx].update(find_matches(restr_matcher, dial_text))
 
 
     return dial_to_rests
 
 
-def consolidate_dialogues(train_pickle, dev_pickle, test_pickle, outfile):
+def consolidate_dialogues(train_pickle, dev_pickle, test_pickle, outfile, store=False,
+                          manifest=False):
     """
     Consolidate the pickled for train/dev/test into one so we can
     split later according to our needs.
     :param train_pickle:
     :param dev_pickle:
     :param test_pickle:
+    :param store: stream dialogues into a DialogueStore instead of pickling one list
+    :param manifest: write a manifest referencing the three files instead of copying
+    their dialogues, read back by load_dialogues as one concatenated dataset
     :return:
     """
-    f_train = open(train_pickle, "r")
-    f_dev = open(dev_pickle, "r")
-    f_test = open(test_pickle, "r")
+    if manifest:
+        write_dialogue_manifest([train_pickle, dev_pickle, test_pickle], ["train", "dev", "test"],
+                                outfile)
+        return
 
-    total_dialogues = []
-    total_dialogues.extend(pickle.load(f_train))
-    total_dialogues.extend(pickle.load(f_dev))
-    total_dialogues.extend(pickle.load(f_test))
+    if store:
+        with DialogueStore(outfile, "w") as out:
+            for filename in [train_pickle, dev_pickle, test_pickle]:
+                out.extend(load_dialogues(filename))
+        return
 
-    f_train.close()
-    f_dev.close()
-    f_test.close()
+    total_dialogues = []
+    total_dialogues.extend(load_dialogues(train_pickle))
+    total_dialogues.extend(load_dialogues(dev_pickle))
+    total_dialogues.extend(load_dialogues(test_pickle))
 
     with open(outfile, "wb") as f:
         pickle.dump(total_dialogues, f)
 
 
+def extract_all_dialogues(filenames, pkl_filenames, restaurant_db, store=False):
+    """
+    Build restaurant DB from scratch from api results of all given files and
+    pickle dialogues of each file
+    :param filenames: list of dialogue files
+    :param pkl_filenames: list of output pickles, one per dialogue file
+    :param restaurant_db:
+    :param store: write DialogueStores instead of pickled lists
+    :return:
+    """
+    if os.path.exists(restaurant_db):
+        os.remove(restaurant_db)
+    build_restaurant_db(filenames, restaurant_db)
+
+    for filename, pkl_filename in zip(filenames, pkl_filenames):
+        num_dialogues = write_dialogues((exchanges for exchanges, _ in iter_dialogues(filename)),
+                                        pkl_filename, store)
+        print "Dialogues: ", num_dialogues
+
+
+def gen_dialogue_vocab_file(dialogue_file, db_file, outfile_name):
+    """
+    Write vocab file of dialogues, restaurant DB and canonicalized entities
+    :param dialogue_file:
+    :param db_file:
+    :param outfile_name:
+    :return:
+    """
+    kb = as_restaurant_kb(db_file)
+    entities = get_entity_name_values(kb)
+    extract_dialogue_vocab(dialogue_file, get_canonicalized_entities(entities), kb, outfile_name)
+
+
+def get_dstc2_stages(raw_files, data_dir, split=(0.8, 0.1, 0.1)):
+    """
+    Return pipeline stages going from raw train/dev/test dialogue files to entity
+    linked, tokenized train/val/test data:
+    extract -> consolidate -> vocab -> sentences -> tokenize -> split -> link_tokenize
+    :param raw_files: list of train, dev and test dialogue files
+    :param data_dir: directory of outputs
+    :param split: train/dev/test fractions
+    :return: list of Stage for run_pipeline
+    """
+    pkl_files = [data_dir + n + "_dialogues.store" for n in ["train", "dev", "test"]]
+    pkl_store_files = [path for f in pkl_files for path in store_files(f)]
+    db = data_dir + "dstc2.db"
+    all_pkl = data_dir + "dstc2_all_dialogues.json"
+    vocab_file = data_dir + "dstc2_vocab_can.txt"
+    sentences = data_dir + "dstc2_sentences.txt"
+    tok_file = data_dir + "dstc2_tok.txt"
+    par_sent_file = data_dir + "dstc2_par_sent.txt"
+    word_to_idx = Deferred(read_vocab_file, (vocab_file,))
+
+    stages = [
+        Stage("extract", extract_all_dialogues, (raw_files, pkl_files, db), {"store": True},
+              raw_files, pkl_store_files + [db]),
+        Stage("consolidate", consolidate_dialogues, tuple(pkl_files) + (all_pkl,),
+              {"manifest": True}, pkl_store_files, [all_pkl]),
+        Stage("vocab", gen_dialogue_vocab_file, (all_pkl, db, vocab_file), {},
+              [all_pkl] + pkl_store_files + [db], [vocab_file]),
+        Stage("sentences", create_dialogues_file, (all_pkl, sentences), {},
+              [all_pkl] + pkl_store_files, [sentences]),
+        Stage("tokenize", tokenize_data,
+              (sentences, tok_file, par_sent_file, word_to_idx, re_patterns), {},
+              [sentences, vocab_file], [tok_file, par_sent_file]),
+        Stage("split", gen_data_split_streaming, (data_dir, "dstc2", list(split)), {},
+              [tok_file, par_sent_file],
+              [data_dir + "dstc2_" + n + suffix for n in ["train", "val", "test"]
+               for suffix in ["_tok.txt", "_sent.txt"]]),
+    ]
+
+    for n in ["train", "val", "test"]:
+        sent_file = data_dir + "dstc2_" + n + "_sent.txt"
+        can_tok_file = data_dir + "dstc2_" + n + "_can_tok.txt"
+        can_sent_file = data_dir + "dstc2_" + n + "_can_sent.txt"
+        stages.append(Stage("link_tokenize_" + n, link_and_tokenize,
+                            (sent_file, can_tok_file, can_sent_file,
+                             Deferred(get_entity_name_values, (db,)), word_to_idx,
+                             canonical_re_pattern), {},
+                            [sent_file, db, vocab_file], [can_tok_file, can_sent_file]))
+
+    return stages
+
 
 re_patterns = r"<|>|[\w]+|,|\?|\.|\(|\)|\\|\"|\/|;|\#|\&|\$|\%|\@|\{|\}|\+|\-|\:"
 
@@ -295,37 +805,37 @@ def extract_dialogue_vocab(dialogue_file, canonicalized_entities, db_file, outfi
     """
     Extract vocab file and populate word_to_idx mapping
     :param dialogue_file:
-    :param dialogue_db:
+    :param db_file: DB file or RestaurantKB
     :return:
     """
     word_to_idx = {}
-    vocab_set = set()
+    vocab_freq = collections.Counter()
+    tokenizer = Tokenizer(re_patterns, cache_size=10000)
 
-    f_dialogue = open(dialogue_file, "r")
-    dialogues = pickle.load(f_dialogue)
+    dialogues = load_dialogues(dialogue_file)
     count = 0
     for dialogue in dialogues:
         for user, system in dialogue:
-            user_set, user_tokens = extract_text_vocab(user, re_patterns)
-            system_set, system_tokens = extract_text_vocab(system, re_patterns)
+            user_tokens = tokenizer.tokens(user)
+            system_tokens = tokenizer.tokens(system)
 
             count += 1
 
-            vocab_set.update(system_set)
-            vocab_set.update(user_set)
+            vocab_freq.update(system_tokens)
+            vocab_freq.update(user_tokens)
 
-    f_dialogue.close()
+    print "Tokenizer cache: ", tokenizer.cache.stats()
+
+    # Dialogue tokens ordered by frequency so ids are reproducible
+    vocab_list = build_freq_vocab(vocab_freq)
 
     # Also get vocab from database
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("SELECT * FROM Restaurants")
-    entries = c.fetchall()
-    for e in entries:
-        vocab_set.update(set(e))
+    kb_vocab = as_restaurant_kb(db_file).vocab()
 
     # Add canonicalized entities
-    vocab_set.update(canonicalized_entities)
+    kb_vocab.update(canonicalized_entities)
+    kb_vocab.difference_update(vocab_list)
+    vocab_list.extend(sorted(kb_vocab))
 
     # Output vocab mapping to file
     idx = 2
@@ -335,8 +845,8 @@ def extract_dialogue_vocab(dialogue_file, canonicalized_entities, db_file, outfi
         word_to_idx["eos"] = 0
         word_to_idx["<unk>"] = 1
 
-        for w in vocab_set:
-            if w == "eos": continue
+        for w in vocab_list:
+            if w == "eos" or w == "<unk>": continue
             # Don't add empty token
             if w == "": continue
             word_to_idx[w] = idx
@@ -347,35 +857,90 @@ def extract_dialogue_vocab(dialogue_file, canonicalized_entities, db_file, outfi
     return word_to_idx
 
 
-def create_dialogues_file(filename, outfilename):
+def create_dialogues_file(filename, outfilename, max_turns=None, max_src_tokens=None):
     """
     Generate filename for dialogues
     :param filename:
+    :param max_turns: max number of utterances in src, including current user
+    utterance (default all)
+    :param max_src_tokens: max number of whitespace-separated tokens of src (default all)
     :return:
     """
 
-    f_dialogue = open(filename, "r")
-    dialogues = pickle.load(f_dialogue)
+    dialogues = load_dialogues(filename)
 
     outfile = open(outfilename, "w")
 
 
     for idx, dialogue in enumerate(dialogues):
-        curr_src = ""
+        curr_src = ContextWindow(max_turns=max_turns, max_tokens=max_src_tokens)
 
         for user, system in dialogue:
-            src = curr_src + " " + user
+            curr_src.append(user)
+            src = curr_src.text()
             target = system
             outfile.write(str(idx) + "\t" + target + "\t" + src + "\n")
 
             # Update curr_src
-            curr_src += " " + user + " " + system
+            curr_src.append(system)
 
 
-    f_dialogue.close()
     outfile.close()
 
 
+def create_dialogue_turns_file(filename, turns_outfilename, index_outfilename):
+    """
+    Generate compact form of create_dialogues_file output: each dialogue's turns
+    are written once as a line "d_idx \t user_1 \t system_1 \t user_2 ...", and each
+    example is a line "d_idx \t turn_idx \t offset" of the index file, where offset is
+    the byte offset of the dialogue's line in the turns file.
+    :param filename: pickled dialogues or DialogueStore
+    :param turns_outfilename:
+    :param index_outfilename:
+    :return:
+    """
+    dialogues = load_dialogues(filename)
+
+    with open(turns_outfilename, "wb") as turns_file, \
+            open(index_outfilename, "wb") as index_file:
+        for idx, dialogue in enumerate(dialogues):
+            offset = turns_file.tell()
+            utterances = [u for turn in dialogue for u in turn]
+            turns_file.write(str(idx) + "\t" + "\t".join(utterances) + "\n")
+
+            for turn_idx in xrange(len(dialogue)):
+                index_file.write("{0}\t{1}\t{2}\n".format(idx, turn_idx, offset))
+
+
+def read_dialogue_examples(turns_filename, index_filename):
+    """
+    Lazily reconstruct examples of create_dialogues_file from turns and index
+    files written by create_dialogue_turns_file
+    :param turns_filename:
+    :param index_filename:
+    :return: generator of (d_idx, target, src) string tuples
+    """
+    curr_offset = None
+    utterances = []
+
+    with open(turns_filename, "rb") as turns_file, open(index_filename, "rb") as index_file:
+        for line in index_file:
+            d_idx, turn_idx, offset = line.split("\t")
+            turn_idx, offset = int(turn_idx), int(offset)
+
+            # Only read dialogue line when moving to a new dialogue
+            if offset != curr_offset:
+                turns_file.seek(offset)
+                utterances = turns_file.readline().rstrip("\n").split("\t")[1:]
+                curr_offset = offset
+
+            user_pos = 2 * turn_idx
+            src = " " + " ".join(utterances[:user_pos + 1])
+            target = utterances[user_pos + 1]
+
+            yield d_idx, target, src
+
+
 
 train_filename = "/Users/mihaileric/Documents/Research/Data/dialog-bAbI-tasks/dialog-babi-task6-dstc2-trn.txt"
 dev_filename = "/Users/mihaileric/Documents/Research/Data/dialog-bAbI-tasks/dialog-babi-task6-dstc2-dev.txt"
@@ -389,6 +954,8 @@ all_pickle = "/Users/mihaileric/Documents/Research/Ford Project/textsum/src/data
 db_file = "/Users/mihaileric/Documents/Research/SNLPDialogue/data/dstc2.db"
 
 if __name__ == "__main__":
+    #run_pipeline(get_dstc2_stages([train_filename, dev_filename, test_filename], "data/"), "data/cache/")
+    #build_restaurant_db([train_filename, dev_filename, test_filename], db_file, num_workers=3)
     #extract_dialogues(train_filename, train_pickle, restaurant_db=db_file)
     #extract_dialogues(dev_filename, dev_pickle, restaurant_db=db_file)
     #extract_dialogues(test_filename, test_pickle, restaurant_db=db_file)
@@ -413,17 +980,12 @@ if __name__ == "__main__":
     can_entities = get_canonicalized_entities(entities)
 
     word_to_idx = extract_dialogue_vocab(all_pickle, can_entities, db_file, "dstc2_vocab_can.txt")
-    entity_link("dstc2_val_sent.txt", "dstc2_val_can.txt", entities)
-    entity_link("dstc2_train_sent.txt", "dstc2_train_can.txt", entities)
-    entity_link("dstc2_test_sent.txt", "dstc2_test_can.txt", entities)
-
-    r = r"<|>|[(\w*)]+|[\w]+|,|\?|\.|\(|\)|\\|\"|\/|;|\#|\&|\$|\%|\@|\{|\}|\+|\-|\:"
-
-    # Tokenize new data files
-    tokenize_data("dstc2_val_can.txt", "dstc2_val_can_tok.txt", "dstc2_val_can_sent.txt",
-                   word_to_idx, r)
-    tokenize_data("dstc2_train_can.txt", "dstc2_train_can_tok.txt", "dstc2_train_can_sent.txt",
-                   word_to_idx, r)
-    tokenize_data("dstc2_test_can.txt", "dstc2_test_can_tok.txt", "dstc2_test_can_sent.txt",
-                   word_to_idx, r)
+
+    # Entity link and tokenize data files
+    link_and_tokenize("dstc2_val_sent.txt", "dstc2_val_can_tok.txt", "dstc2_val_can_sent.txt",
+                      entities, word_to_idx, canonical_re_pattern)
+    link_and_tokenize("dstc2_train_sent.txt", "dstc2_train_can_tok.txt", "dstc2_train_can_sent.txt",
+                      entities, word_to_idx, canonical_re_pattern)
+    link_and_tokenize("dstc2_test_sent.txt", "dstc2_test_can_tok.txt", "dstc2_test_can_sent.txt",
+                      entities, word_to_idx, canonical_re_pattern)
 
@@ -0,0 +1,230 @@
+import collections
+import cPickle as pickle
+import numpy as np
+import os.path
+import sqlite3
+
+"""
+In-memory knowledge base of the Restaurants table, loaded once from the DB (or a
+snapshot of it) and serving entity values, vocabulary and attribute lookups.
+"""
+
+# Columns of Restaurants table, in order
+kb_columns = ["name", "post_code", "cuisine", "location", "phone", "address", "price", "rating"]
+# Columns with inverted indexes, matched case-insensitively by lookup
+indexed_columns = ["name", "cuisine", "location", "price"]
+# Columns whose values are entities linked in dialogues
+entity_columns = ["price", "cuisine", "location"]
+
+# First bytes of snapshot files written by RestaurantKB.save
+snapshot_magic = "RESTKB1\n"
+
+
+class RestaurantKB(object):
+    """
+    Rows of Restaurants table stored by column. Each column keeps its distinct values
+    once and an array of value codes per row. Indexed columns map each lowercased
+    value to the sorted array of ids of rows having it.
+    """
+
+    def __init__(self, values, codes):
+        """
+        :param values: dict mapping column to list of distinct values
+        :param codes: dict mapping column to int32 array of row value codes
+        """
+        self.values = values
+        self.codes = codes
+        self.num_rows = len(codes[kb_columns[0]])
+        self.indexes = {}
+
+        for column in indexed_columns:
+            keys = [v.lower() if v is not None else None for v in values[column]]
+            index = collections.defaultdict(list)
+            for row_id, code in enumerate(codes[column]):
+                if keys[code] is not None:
+                    index[keys[code]].append(row_id)
+
+            self.indexes[column] = dict((key, np.array(row_ids, dtype=np.int64))
+                                        for key, row_ids in index.iteritems())
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build KB from sequence of Restaurants rows
+        :param rows: tuples of values of kb_columns
+        :return:
+        """
+        values = dict((column, []) for column in kb_columns)
+        codes = dict((column, []) for column in kb_columns)
+        code_of = dict((column, {}) for column in kb_columns)
+
+        for row in rows:
+            for column, value in zip(kb_columns, row):
+                code = code_of[column].get(value)
+                if code is None:
+                    code = code_of[column][value] = len(values[column])
+                    values[column].append(value)
+                codes[column].append(code)
+
+        return cls(values, dict((column, np.array(codes[column], dtype=np.int32))
+                                for column in kb_columns))
+
+    @classmethod
+    def from_db(cls, db_file):
+        """
+        Load KB with a single query of the Restaurants table, in row insertion order
+        :param db_file:
+        :return:
+        """
+        conn = sqlite3.connect(db_file)
+        try:
+            rows = conn.execute("SELECT {0} FROM Restaurants ORDER BY rowid".format(
+                ", ".join(kb_columns))).fetchall()
+        finally:
+            conn.close()
+
+        return cls.from_rows(rows)
+
+    def save(self, snapshot_file):
+        """
+        Write columns of KB to snapshot file read by load
+        :param snapshot_file:
+        :return:
+        """
+        with open(snapshot_file, "wb") as f:
+            f.write(snapshot_magic)
+            pickle.dump((self.values, self.codes), f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, snapshot_file):
+        """
+        Read KB from snapshot file written by save
+        :param snapshot_file:
+        :return:
+        """
+        with open(snapshot_file, "rb") as f:
+            if f.read(len(snapshot_magic)) != snapshot_magic:
+                raise ValueError("Not a restaurant KB snapshot: {0}".format(snapshot_file))
+            values, codes = pickle.load(f)
+
+        return cls(values, codes)
+
+    def __len__(self):
+        return self.num_rows
+
+    def column(self, column):
+        """
+        Return list of values of column for all rows
+        :param column:
+        :return:
+        """
+        values = self.values[column]
+        return [values[c] for c in self.codes[column]]
+
+    def row(self, row_id):
+        """
+        Return tuple of values of kb_columns of row
+        :param row_id:
+        :return:
+        """
+        return tuple(self.values[column][self.codes[column][row_id]] for column in kb_columns)
+
+    def rows(self):
+        for row_id in xrange(self.num_rows):
+            yield self.row(row_id)
+
+    def names(self):
+        """
+        Return set of names of all restaurants
+        :return:
+        """
+        return set(self.column("name"))
+
+    def entity_name_values(self):
+        """
+        Return dict mapping each entity column to set of its non-empty values
+        :return:
+        """
+        name_to_values = collections.defaultdict(set)
+        for column in entity_columns:
+            name_to_values[column] = set(v for v in self.column(column) if v != "")
+
+        return name_to_values
+
+    def vocab(self):
+        """
+        Return set of all values of all columns
+        :return:
+        """
+        vocab = set()
+        for column in kb_columns:
+            vocab.update(self.values[column])
+
+        return vocab
+
+    def lookup(self, **constraints):
+        """
+        Return sorted array of ids of rows matching all constraints, e.g.
+        lookup(cuisine="chinese", price="cheap"). Values of indexed columns are matched
+        case-insensitively, and None matches any value.
+        :param constraints: mapping of indexed column to value
+        :return:
+        """
+        matches = []
+        for column, value in constraints.iteritems():
+            if value is None:
+                continue
+            if column not in self.indexes:
+                raise ValueError("Column {0} is not indexed".format(column))
+            matches.append(self.indexes[column].get(value.lower(), np.zeros(0, dtype=np.int64)))
+
+        if not matches:
+            return np.arange(self.num_rows)
+
+        # Intersect starting from the most selective column
+        matches.sort(key=len)
+        result = matches[0]
+        for m in matches[1:]:
+            result = np.intersect1d(result, m, assume_unique=True)
+
+        return result
+
+    def lookup_names(self, **constraints):
+        """
+        Return frozenset of names of restaurants matching constraints of lookup
+        :param constraints:
+        :return:
+        """
+        names = self.values["name"]
+        name_codes = self.codes["name"]
+        return frozenset(names[name_codes[row_id]] for row_id in self.lookup(**constraints))
+
+
+def load_restaurant_kb(db_file, snapshot_file=None):
+    """
+    Return KB of DB, read from snapshot file if it is newer than the DB, else
+    loaded from the DB and saved to the snapshot file if one is given
+    :param db_file:
+    :param snapshot_file:
+    :return:
+    """
+    if snapshot_file is not None and os.path.exists(snapshot_file) and \
+            os.path.getmtime(snapshot_file) >= os.path.getmtime(db_file):
+        return RestaurantKB.load(snapshot_file)
+
+    kb = RestaurantKB.from_db(db_file)
+    if snapshot_file is not None:
+        kb.save(snapshot_file)
+
+    return kb
+
+
+def as_restaurant_kb(db):
+    """
+    Return db itself if it is a RestaurantKB, else KB loaded from DB file db
+    :param db:
+    :return:
+    """
+    if isinstance(db, RestaurantKB):
+        return db
+    return RestaurantKB.from_db(db)
@@ -1,13 +1,34 @@
 import collections
 import cPickle as pickle
+import gzip
+import hashlib
+import itertools
 import json
+import multiprocessing
+import numpy as np
+import os
+import os.path
 
-from data_utils import extract_text_vocab, clean_text
+from data_utils import clean_text, clean_so_question, iter_so_questions, iter_mailman_threads, \
+    get_line_chunks, Tokenizer
 
 """
 General utilities for generating relevant vocabularies from data.
 """
 
+tokenizer = Tokenizer()
+
+def open_glv_file(glv_file):
+    """
+    Open GloVe text file, which may be gzipped
+    :param glv_file:
+    :return:
+    """
+    if glv_file.endswith(".gz"):
+        return gzip.open(glv_file, "rb")
+    return open(glv_file, "rb")
+
+
 def get_glv_vocab(glv_file):
     """
     Output set with all tokens in GloVe vocabulary
@@ -15,15 +36,126 @@ def get_glv_vocab(glv_file):
     :return:
     """
     glv_vocab = set()
-    with open(glv_file) as f:
+    with open_glv_file(glv_file) as f:
         for line in f:
-            contents = line.split(" ")
-            glv_vocab.add(contents[0])
+            # Only split off the word, not the floats of its vector
+            glv_vocab.add(line.split(" ", 1)[0])
 
     print "Len GloVe vocab: ", len(glv_vocab)
     return glv_vocab
 
 
+def get_glv_key(glv_file, word_to_idx):
+    """
+    Return key identifying embedding matrix built from given GloVe file and vocab
+    :param glv_file:
+    :param word_to_idx:
+    :return:
+    """
+    stat = os.stat(glv_file)
+    sha = hashlib.sha1()
+    for w, idx in sorted(word_to_idx.iteritems(), key=lambda item: item[1]):
+        sha.update(str(idx) + "\t" + w + "\n")
+
+    return {"glv_file": os.path.abspath(glv_file), "glv_size": stat.st_size,
+            "glv_mtime": stat.st_mtime, "vocab": sha.hexdigest()}
+
+
+def build_glv_matrix(glv_file, word_to_idx):
+    """
+    Scan GloVe file once, parsing vectors only of words in word_to_idx. If a word
+    occurs several times, its first vector is used.
+    :param glv_file:
+    :param word_to_idx:
+    :return: float32 matrix with row idx holding vector of word with that idx. Rows of
+    words missing from GloVe (e.g. eos and <unk>) are zero.
+    """
+    matrix = None
+    found = np.zeros(max(word_to_idx.values()) + 1, dtype=bool)
+
+    with open_glv_file(glv_file) as f:
+        for line in f:
+            w, rest = line.rstrip().split(" ", 1)
+            if matrix is None:
+                dim = rest.count(" ") + 1
+                matrix = np.zeros((len(found), dim), dtype=np.float32)
+
+            idx = word_to_idx.get(w)
+            if idx is None or found[idx]:
+                continue
+
+            vec = np.fromstring(rest, dtype=np.float32, sep=" ")
+            # Some GloVe words contain spaces, so their line splits off the wrong word
+            if len(vec) != dim:
+                continue
+            matrix[idx] = vec
+            found[idx] = True
+
+    if matrix is None:
+        raise ValueError("GloVe file {0} has no vectors".format(glv_file))
+
+    print "Found {0} of {1} vocab words in GloVe".format(found.sum(), len(word_to_idx))
+    return matrix
+
+
+def load_glv_matrix(glv_file, word_to_idx, matrix_file):
+    """
+    Return embedding matrix aligned to word_to_idx, memory-mapped from matrix_file.
+    The matrix is built with build_glv_matrix and saved to matrix_file (with a
+    key sidecar file) unless it was already saved for the same GloVe file and vocab.
+    :param glv_file: GloVe text file, may be gzipped
+    :param word_to_idx:
+    :param matrix_file: .npy file to cache matrix in
+    :return: read-only memory-mapped matrix
+    """
+    key_file = matrix_file + ".key.json"
+    key = get_glv_key(glv_file, word_to_idx)
+
+    cached_key = None
+    if os.path.exists(matrix_file) and os.path.exists(key_file):
+        with open(key_file, "rb") as f:
+            cached_key = json.load(f)
+
+    if cached_key != key:
+        matrix = build_glv_matrix(glv_file, word_to_idx)
+        # Write key last so an interrupted save is never reused
+        if os.path.exists(key_file):
+            os.remove(key_file)
+        with open(matrix_file, "wb") as f:
+            np.save(f, matrix)
+        with open(key_file, "wb") as f:
+            json.dump(key, f)
+
+    return np.load(matrix_file, mmap_mode="r")
+
+
+def get_so_question_texts(question):
+    """
+    Return cleaned texts of SO question body, comments, answers and answer comments
+    :param question: dict of SO question
+    :return:
+    """
+    # TODO: Whether to include text of question title?
+    question = clean_so_question(question)
+    texts = [question["body"]]
+    texts.extend(question["comments"])
+
+    for a in question["answers"]:
+        texts.append(a["text"])
+        texts.extend(a["comments"])
+
+    return texts
+
+
+def so_question_has_answer(question):
+    """
+    Return whether SO question has any comments or answers to form a dialogue
+    :param question:
+    :return:
+    """
+    return len(question["answers"]) != 0 or len(question["comments"]) != 0
+
+
 def get_so_vocab(data_file, skip_no_answer=False):
     """
     Iterate through all text of SO data, tokenize, and generate a list
@@ -31,56 +163,20 @@ def get_so_vocab(data_file, skip_no_answer=False):
     :param data_file:
     :return:
     """
-    with open(data_file, "rb") as f:
-        data = json.load(f)
-
     vocab = set()
     vocab_freq = collections.Counter()
 
-    for question in data:
-        # TODO: Whether to include text of question title?
-        question = json.loads(question)
-
-        q_body = question["body"]
-        q_body = clean_text(q_body)
-
-        answers = question["answers"]
-        comments = question["comments"]
-
+    for question in iter_so_questions(data_file):
         if skip_no_answer:
             # There is no dialogue because no comments/answers to question
-            if len(answers) == 0 and len(comments) == 0:
+            if not so_question_has_answer(question):
                 continue
 
-        # Extract vocab from question body
-        body_set, body_list = extract_text_vocab(q_body)
-        vocab_freq.update(body_set)
-        vocab.update(body_set)
-
-        # Extract vocab from question comments
-        for c in comments:
-            c = c.encode("utf-8")
-            c = clean_text(c)
-            c_voc, c_list = extract_text_vocab(c)
-            vocab_freq.update(c_voc)
-            vocab.update(c_voc)
-
-        # Extract vocab from question answers and answer comments
-        for a in answers:
-            a_text = a["text"].encode("utf-8")
-            a_text = clean_text(a_text)
-            a_voc, a_list = extract_text_vocab(a_text)
-            vocab_freq.update(a_voc)
-            vocab.update(a_voc)
-
-            a_comments = a["comments"]
-            for a_c in a_comments:
-                a_c = a_c.encode("utf-8")
-                a_c = clean_text(a_c)
-                a_c_vocab, a_c_list = extract_text_vocab(a_c)
-                vocab_freq.update(a_c_vocab)
-                vocab.update(a_c_vocab)
-
+        # Extract vocab from question body, comments, answers and answer comments
+        for text in get_so_question_texts(question):
+            text_voc = tokenizer.token_set(text)
+            vocab_freq.update(text_voc)
+            vocab.update(text_voc)
 
     return vocab, vocab_freq
 
@@ -92,14 +188,11 @@ def get_mailman_vocab(data_file, skip_no_answer=False):
     :param data_file:
     :return:
     """
-    with open(data_file, "rb") as f:
-        data = json.load(f)
-
     vocab = set()
     vocab_freq = collections.Counter()
 
     # TODO: Whether to process title for vocab?
-    for _, thread in data.iteritems():
+    for _, thread in iter_mailman_threads(data_file):
         if skip_no_answer:
             # No answer given
             if len(thread) == 1:
@@ -107,7 +200,7 @@ def get_mailman_vocab(data_file, skip_no_answer=False):
 
         thread_vocab = set()
         for t in thread:
-            thread_voc, thread_list = extract_text_vocab(clean_text(t))
+            thread_voc = tokenizer.token_set(clean_text(t))
             vocab_freq.update(thread_voc)
             thread_vocab.update(thread_voc)
 
@@ -116,18 +209,158 @@ def get_mailman_vocab(data_file, skip_no_answer=False):
     return vocab, vocab_freq
 
 
-def gen_vocab_file(data_dir):
+def _iter_jsonl_range(data_file, start, end):
+    with open(data_file, "rb") as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield json.loads(line)
+
+
+def count_vocab_shard(task):
+    """
+    Count document frequency (number of texts containing a word, as vocab_freq of
+    get_so_vocab/get_mailman_vocab) and term frequency of words in a corpus shard
+    :param task: (corpus, shard, skip_no_answer) where corpus is "so" or "mailman" and
+    shard is either a list of records or a (jsonl file, start, end) byte range
+    :return: (doc_freq, term_freq) Counters
+    """
+    corpus, shard, skip_no_answer = task
+    records = _iter_jsonl_range(*shard) if isinstance(shard, tuple) else shard
+
+    doc_freq = collections.Counter()
+    term_freq = collections.Counter()
+
+    for record in records:
+        if corpus == "so":
+            if skip_no_answer and not so_question_has_answer(record):
+                continue
+            texts = get_so_question_texts(record)
+        else:
+            thread = record[1]
+            if skip_no_answer and len(thread) == 1:
+                continue
+            texts = [clean_text(t) for t in thread]
+
+        for text in texts:
+            tokens = tokenizer.tokens(text)
+            term_freq.update(tokens)
+            doc_freq.update(set(tokens))
+
+    return doc_freq, term_freq
+
+
+def get_vocab_shards(data_file, corpus, num_shards, shard_size=1000):
+    """
+    Yield shards of SO or mailman data. json-lines files are split into byte
+    ranges read by the workers themselves, other files into lists of shard_size records.
+    :param data_file:
+    :param corpus: "so" or "mailman"
+    :param num_shards: number of shards for json-lines files
+    :param shard_size: number of records per shard for other files
+    :return:
+    """
+    if data_file.endswith(".jsonl"):
+        for start, end in get_line_chunks(data_file, num_shards):
+            yield data_file, start, end
+        return
+
+    records = iter_so_questions(data_file) if corpus == "so" else iter_mailman_threads(data_file)
+    while True:
+        shard = list(itertools.islice(records, shard_size))
+        if not shard:
+            break
+        yield shard
+
+
+def get_vocab_sharded(data_files, skip_no_answer=False, num_workers=None, shard_size=1000):
+    """
+    Count vocab of several corpora over shards in a pool of processes, merging
+    the per-shard Counters
+    :param data_files: dict mapping corpus ("so" or "mailman") to data file
+    :param skip_no_answer:
+    :param num_workers: number of processes (defaults to number of cpus)
+    :param shard_size: number of records per shard of non json-lines files
+    :return: dict mapping corpus to (vocab, doc_freq, term_freq)
+    """
+    num_workers = num_workers or multiprocessing.cpu_count()
+    tasks = ((corpus, shard, skip_no_answer)
+             for corpus, data_file in data_files.items()
+             for shard in get_vocab_shards(data_file, corpus, num_workers * 4, shard_size))
+
+    doc_freqs = dict((corpus, collections.Counter()) for corpus in data_files)
+    term_freqs = dict((corpus, collections.Counter()) for corpus in data_files)
+
+    pool = multiprocessing.Pool(num_workers)
+    # Tag each result with its corpus, since imap_unordered returns shards as they finish
+    for corpus, (doc_freq, term_freq) in pool.imap_unordered(_count_tagged_vocab_shard, tasks):
+        doc_freqs[corpus].update(doc_freq)
+        term_freqs[corpus].update(term_freq)
+    pool.close()
+    pool.join()
+
+    return dict((corpus, (set(doc_freqs[corpus]), doc_freqs[corpus], term_freqs[corpus]))
+                for corpus in data_files)
+
+
+def _count_tagged_vocab_shard(task):
+    return task[0], count_vocab_shard(task)
+
+
+def gen_vocab_file(data_dir, max_size=None, min_count=1):
     """
     Provide a list of data files (in this case of json-encoded SO and mailman)
-    and process to create a vocab file.
+    and process to create a vocab file. Ids are assigned by descending frequency.
     :param data_files:
+    :param max_size: max number of ids in each vocab, including eos and <unk>
+    :param min_count: min frequency of words kept in each vocab
     :return:
     """
-    total_vocab = set()
-    total_freq = collections.Counter()
     so_vocab, so_freq = get_so_vocab(data_dir + "snlp_so_questions.json", skip_no_answer=True)
     mailman_vocab, mailman_freq = get_mailman_vocab(data_dir + "nlp_user_questions_space.json", skip_no_answer=True)
 
+    return write_vocab_files(data_dir, so_vocab, so_freq, mailman_vocab, mailman_freq,
+                             max_size, min_count)
+
+
+def gen_vocab_file_sharded(data_dir, num_workers=None, max_size=None, min_count=1,
+                           so_file="snlp_so_questions.json",
+                           mailman_file="nlp_user_questions_space.json"):
+    """
+    Same as gen_vocab_file but count both corpora over shards in a pool of processes
+    :param data_dir:
+    :param num_workers: number of processes (defaults to number of cpus)
+    :param max_size: max number of ids in each vocab, including eos and <unk>
+    :param min_count: min frequency of words kept in each vocab
+    :param so_file: SO data file in data_dir (json or json-lines)
+    :param mailman_file: mailman data file in data_dir (json or json-lines)
+    :return:
+    """
+    counts = get_vocab_sharded({"so": data_dir + so_file, "mailman": data_dir + mailman_file},
+                               skip_no_answer=True, num_workers=num_workers)
+    so_vocab, so_freq, _ = counts["so"]
+    mailman_vocab, mailman_freq, _ = counts["mailman"]
+
+    return write_vocab_files(data_dir, so_vocab, so_freq, mailman_vocab, mailman_freq,
+                             max_size, min_count)
+
+
+def write_vocab_files(data_dir, so_vocab, so_freq, mailman_vocab, mailman_freq, max_size=None,
+                      min_count=1):
+    """
+    Write SO, mailman and combined vocab files from vocab sets and frequencies
+    :param data_dir:
+    :param max_size: max number of ids in each vocab, including eos and <unk>
+    :param min_count: min frequency of words kept in each vocab
+    :return:
+    """
+    total_vocab = set()
+    total_freq = collections.Counter()
+
     # Update total vocab set
     total_vocab.update(so_vocab)
     total_vocab.update(mailman_vocab)
@@ -144,28 +377,69 @@ def gen_vocab_file(data_dir):
 
     # Generate vocab files for SO
     so_word_to_idx = {}
-    write_vocab_file(data_dir + "so_vocab.txt", so_vocab, so_word_to_idx)
+    write_vocab_file(data_dir + "so_vocab.txt", build_freq_vocab(so_freq, max_size, min_count),
+                     so_word_to_idx)
 
     # Generate vocab files for mailman
     mailman_word_to_idx = {}
-    write_vocab_file(data_dir + "mailman_vocab.txt", mailman_vocab, mailman_word_to_idx)
+    write_vocab_file(data_dir + "mailman_vocab.txt",
+                     build_freq_vocab(mailman_freq, max_size, min_count), mailman_word_to_idx)
 
     # Generate vocab files for combined
     total_word_to_idx = {}
-    write_vocab_file(data_dir + "so+mailman_vocab.txt", total_vocab, total_word_to_idx)
+    write_vocab_file(data_dir + "so+mailman_vocab.txt",
+                     build_freq_vocab(total_freq, max_size, min_count), total_word_to_idx)
 
     return so_vocab, mailman_vocab, total_vocab,\
            so_word_to_idx, mailman_word_to_idx, total_word_to_idx
 
 
+def read_vocab_file(file_name):
+    """
+    Read word_to_idx mapping from vocab file written by write_vocab_file
+    :param file_name:
+    :return:
+    """
+    word_to_idx = {}
+    with open(file_name, "rb") as f:
+        for line in f:
+            idx, w = line.rstrip("\n").split("\t", 1)
+            word_to_idx[w] = int(idx)
+
+    return word_to_idx
+
+
+def build_freq_vocab(vocab_freq, max_size=None, min_count=1):
+    """
+    Return list of words ordered by descending frequency, ties broken alphabetically
+    so that ids are reproducible. Words cut off by max_size or min_count are left
+    to be mapped to <unk>.
+    :param vocab_freq: Counter of word frequencies
+    :param max_size: max number of ids in vocab, including eos and <unk>
+    :param min_count: min frequency of words kept
+    :return:
+    """
+    words = [w for w, count in vocab_freq.iteritems()
+             if count >= min_count and w != "eos" and w != "<unk>"]
+    words.sort(key=lambda w: (-vocab_freq[w], w))
+
+    if max_size is not None:
+        words = words[:max(max_size - 2, 0)]
+
+    return words
+
+
 def write_vocab_file(file_name, vocab, word_to_idx):
     """
     Writes vocab file to given file_name and populate word_to_idx mapping
-    and pickles mapping
+    and pickles mapping. Ids follow order of vocab if it is a list, else sorted order.
     :param file_name:
     :param word_to_idx:
     :return:
     """
+    if not isinstance(vocab, list):
+        vocab = sorted(vocab)
+
     idx = 2
     with open(file_name, "wb") as f:
         f.write("0" + "\t" + "eos" + "\n")
@@ -174,7 +448,7 @@ def write_vocab_file(file_name, vocab, word_to_idx):
         word_to_idx["<unk>"] = 1
 
         for w in vocab:
-            if w == "eos": continue
+            if w == "eos" or w == "<unk>": continue
             word_to_idx[w] = idx
             f.write(str(idx) + "\t" + w + "\n")
             idx += 1